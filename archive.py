@@ -0,0 +1,333 @@
+
+import io
+import json
+import hashlib
+import zipfile
+import threading
+from urlparse import parse_qsl, urljoin
+
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+import googlemaps
+from bs4 import BeautifulSoup
+from selenium.common.exceptions import NoSuchElementException
+
+from discovery import canonical_url
+
+
+INDEX = 'index.json'
+
+# Form fields that change on every page load or must never be written to disk
+_VOLATILE_FIELDS = ('viewstate', 'eventvalidation', 'username', 'password')
+
+# Response headers a replayed response needs: redirects and the charset
+_KEPT_HEADERS = ('location', 'content-type')
+
+
+class NotArchived(requests.exceptions.ConnectionError):
+    """The request was not recorded; to the loaders it looks like an unreachable host."""
+
+
+def request_key(method, url, body=None):
+    """Stable key of a request: method, canonical URL and the form fields that select the page.
+
+    ASP.NET state and credentials are left out, so a month postback replays
+    whatever view state it was sent with and no password reaches the archive.
+    """
+    fields = []
+    if body:
+        fields = sorted((name, value) for name, value in parse_qsl(body, True)
+                        if not any(word in name.lower() for word in _VOLATILE_FIELDS))
+    text = json.dumps([method.upper(), canonical_url(url), fields])
+    return hashlib.sha1(text).hexdigest(), text
+
+
+def maps_key(method, args, kwargs):
+    text = json.dumps(['MAPS', method, args, kwargs], sort_keys=True)
+    return hashlib.sha1(text).hexdigest(), text
+
+
+class Archive(object):
+    """Zip of recorded site pages and Maps answers, one deflated member per response.
+
+    In 'record' mode every response is added as it arrives (a later answer
+    to the same request replaces an earlier one) and the index is written
+    on close(). In 'replay' mode the index is read once and each lookup
+    reads a single member straight from the zip's central directory, so
+    replaying costs about as much as the parsing.
+    """
+
+    def __init__(self, path, mode='replay'):
+        if mode not in ('record', 'replay'):
+            raise ValueError('mode must be record or replay, not {!r}'.format(mode))
+        self.path = path
+        self.mode = mode
+        self._lock = threading.Lock()
+        if mode == 'record':
+            self._zip = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+            self._index = dict()
+        else:
+            self._zip = zipfile.ZipFile(path, 'r', allowZip64=True)
+            self._index = json.loads(self._zip.read(INDEX))
+
+    @property
+    def replaying(self):
+        return self.mode == 'replay'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            if self._zip is None:
+                return
+            if self.mode == 'record':
+                self._zip.writestr(INDEX, json.dumps(self._index, indent=1, sort_keys=True))
+            self._zip.close()
+            self._zip = None
+
+    def put(self, key, request, content, **meta):
+        with self._lock:
+            member = '{}/{}'.format(key, len(self._zip.filelist))
+            self._zip.writestr(member, content)
+            meta.update(member=member, request=request)
+            self._index[key] = meta
+
+    def get(self, key, request=None):
+        """(content, meta) of a recorded response; NotArchived when it was never recorded."""
+        meta = self._index.get(key)
+        if meta is None:
+            raise NotArchived('not in {}: {}'.format(self.path, request or key))
+        with self._lock:
+            return self._zip.read(meta['member']), meta
+
+    ##########################
+    #### requests support ####
+    ##########################
+
+    def adapter(self, **kwargs):
+        """Transport adapter that records into or replays from the archive."""
+        if self.replaying:
+            return ReplayAdapter(self)
+        return RecordingAdapter(self, **kwargs)
+
+    def mount(self, session, **kwargs):
+        adapter = self.adapter(**kwargs)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    ##############################
+    #### Maps and Chrome side ####
+    ##############################
+
+    def maps(self, client=None):
+        """googlemaps.Client stand-in: client with its answers recorded, or the recorded answers alone."""
+        return MapsReplay(self) if self.replaying else MapsRecorder(client, self)
+
+    def driver(self, driver=None):
+        """WebDriver stand-in: driver with its pages recorded, or a browser-less reader of the recorded pages."""
+        return DriverReplay(self) if self.replaying else DriverRecorder(driver, self)
+
+
+class RecordingAdapter(HTTPAdapter):
+
+    def __init__(self, archive, **kwargs):
+        super(RecordingAdapter, self).__init__(**kwargs)
+        self._archive = archive
+
+    def send(self, request, **kwargs):
+        response = super(RecordingAdapter, self).send(request, **kwargs)
+        # Throttled answers are retried, so only the eventual page is worth keeping
+        if response.status_code not in (429, 503):
+            key, text = request_key(request.method, request.url, request.body)
+            headers = dict((name, value) for name, value in response.headers.items() if name.lower() in _KEPT_HEADERS)
+            self._archive.put(key, text, response.content, status=response.status_code, headers=headers)
+        return response
+
+
+class ReplayAdapter(BaseAdapter):
+
+    def __init__(self, archive):
+        super(ReplayAdapter, self).__init__()
+        self._archive = archive
+
+    def send(self, request, **kwargs):
+        key, text = request_key(request.method, request.url, request.body)
+        content, meta = self._archive.get(key, text)
+        response = requests.Response()
+        response.status_code = meta['status']
+        response.headers = CaseInsensitiveDict(meta['headers'])
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.raw = io.BytesIO(content)
+        response._content = content
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        return response
+
+    def close(self):
+        pass
+
+
+class MapsRecorder(object):
+
+    def __init__(self, client, archive):
+        self.client = client
+        self._archive = archive
+
+    def _call(self, method, *args, **kwargs):
+        result = getattr(self.client, method)(*args, **kwargs)
+        key, text = maps_key(method, args, kwargs)
+        self._archive.put(key, text, json.dumps(result))
+        return result
+
+    def geocode(self, *args, **kwargs):
+        return self._call('geocode', *args, **kwargs)
+
+    def distance_matrix(self, *args, **kwargs):
+        return self._call('distance_matrix', *args, **kwargs)
+
+
+class MapsReplay(object):
+
+    def __init__(self, archive):
+        self._archive = archive
+
+    def _call(self, method, *args, **kwargs):
+        key, text = maps_key(method, args, kwargs)
+        try:
+            content, meta = self._archive.get(key, text)
+        except NotArchived as error:
+            raise googlemaps.exceptions.TransportError(error)
+        return json.loads(content)
+
+    def geocode(self, *args, **kwargs):
+        return self._call('geocode', *args, **kwargs)
+
+    def distance_matrix(self, *args, **kwargs):
+        return self._call('distance_matrix', *args, **kwargs)
+
+
+#########################
+#### WebDriver pages ####
+#########################
+
+class _RecordedClick(object):
+
+    def __init__(self, element, driver, element_id):
+        self._element = element
+        self._driver = driver
+        self._id = element_id
+
+    def __getattr__(self, name):
+        return getattr(self._element, name)
+
+    def click(self):
+        url = self._driver.current_url
+        self._element.click()
+        self._driver._record('CLICK', url, self._id)
+
+
+class DriverRecorder(object):
+    """WebDriver whose page loads and clicks by element id are added to the archive.
+
+    Pages are stored as Chrome rendered them; a GET is keyed like the same
+    request made through requests, so either loader can replay it.
+    """
+
+    def __init__(self, driver, archive):
+        self._driver = driver
+        self._archive = archive
+
+    def __getattr__(self, name):
+        return getattr(self._driver, name)
+
+    def _record(self, method, url, body=None):
+        key, text = request_key(method, url, body)
+        self._archive.put(key, text, self._driver.page_source.encode('utf-8'), status=200,
+                          headers={'content-type': 'text/html; charset=utf-8'}, final_url=self._driver.current_url)
+
+    def get(self, url):
+        self._driver.get(url)
+        self._record('GET', url)
+
+    def find_element_by_id(self, element_id):
+        return _RecordedClick(self._driver.find_element_by_id(element_id), self, element_id)
+
+
+class _ReplayElement(object):
+
+    def __init__(self, tag, driver):
+        self._tag = tag
+        self._driver = driver
+
+    @property
+    def text(self):
+        # Close to Chrome's rendered text: one line per text node, whitespace collapsed
+        lines = (' '.join(text.split()) for text in self._tag.strings)
+        return '\n'.join(line for line in lines if line)
+
+    def get_attribute(self, name):
+        value = self._tag.get(name)
+        return ' '.join(value) if isinstance(value, list) else value
+
+    def is_enabled(self):
+        return not self._tag.has_attr('disabled')
+
+    def is_selected(self):
+        return self._tag.has_attr('checked') or self._tag.has_attr('selected')
+
+    def click(self):
+        self._driver._click(self._tag.get('id'))
+
+
+class DriverReplay(object):
+    """Browser-less WebDriver reading the recorded pages, for parsing load2's pages offline."""
+
+    def __init__(self, archive):
+        self._archive = archive
+        self.current_url = None
+        self.page_source = u''
+        self._soup = None
+
+    def _load(self, method, url, body=None):
+        key, text = request_key(method, url, body)
+        content, meta = self._archive.get(key, text)
+        # Pages recorded through requests may be redirects
+        while meta['status'] in (301, 302, 303, 307) and meta['headers'].get('location'):
+            url = urljoin(url, meta['headers']['location'])
+            key, text = request_key('GET', url)
+            content, meta = self._archive.get(key, text)
+        self.current_url = meta.get('final_url', url)
+        self.page_source = content.decode('utf-8', 'replace')
+        self._soup = BeautifulSoup(content, 'html.parser')
+
+    def get(self, url):
+        self._load('GET', url)
+
+    def _click(self, element_id):
+        self._load('CLICK', self.current_url, element_id)
+
+    def find_element_by_id(self, element_id):
+        tag = self._soup.find(id=element_id) if self._soup is not None else None
+        if tag is None:
+            raise NoSuchElementException('no element {} on {}'.format(element_id, self.current_url))
+        return _ReplayElement(tag, self)
+
+    def add_cookie(self, cookie):
+        pass
+
+    def get_cookies(self):
+        return []
+
+    def close(self):
+        pass
+
+    def quit(self):
+        pass
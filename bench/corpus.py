@@ -0,0 +1,67 @@
+"""
+Saved calendar and event pages the offline benchmarks run against.
+
+The pages live in corpus/ and are dated from CORPUS_START on, so they stay
+in the future and survive the loaders' date filters. Regenerate them from
+the stand-in site with:
+
+    python bench/corpus.py --events 20
+"""
+import os
+import re
+import glob
+import argparse
+from datetime import date
+
+import standin
+
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus')
+CORPUS_START = date(2031, 1, 1)
+BASE_URL = 'https://singles.eventsandadventures.com/website/'
+
+
+def _number(path):
+    return int(re.search(r'(\d+)\.html$', path).group(1))
+
+
+def pages(kind):
+    """Return [(url, content)] for the saved 'event' or 'calendar' pages, in calendar order."""
+    result = []
+    for path in sorted(glob.glob(os.path.join(CORPUS, '{}_*.html'.format(kind))), key=_number):
+        with open(path, 'rb') as f:
+            content = f.read()
+        if kind == 'event':
+            url = '{}event.aspx?id={}'.format(BASE_URL, _number(path))
+        else:
+            url = '{}calendar.aspx'.format(BASE_URL)
+        result.append((url, content))
+    return result
+
+
+def write(events):
+    if not os.path.exists(CORPUS):
+        os.mkdir(CORPUS)
+    for path in glob.glob(os.path.join(CORPUS, '*.html')):
+        os.remove(path)
+
+    site = standin.Site(events, start=CORPUS_START)
+    for month_idx in range(3):
+        with open(os.path.join(CORPUS, 'calendar_{}.html'.format(month_idx)), 'wb') as f:
+            f.write(site.calendar(month_idx))
+        for num in range(events):
+            event_id = month_idx * 1000 + num
+            with open(os.path.join(CORPUS, 'event_{}.html'.format(event_id)), 'wb') as f:
+                f.write(standin.render('event.html', **site.event(event_id)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--events', type=int, default=20, help='events per calendar month')
+    args = parser.parse_args()
+    write(args.events)
+    print('Wrote {} calendar and {} event pages to {}'.format(len(pages('calendar')), len(pages('event')), CORPUS))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,11 @@
+"""
+Stand-in for the private info.py so the loaders import offline.
+
+The bench scripts put this directory first on sys.path; nothing here is
+a real credential.
+"""
+GOOGLE_MAPS_KEY = 'AIzaStandInKeyForOfflineBenchmarks000000'
+EA_USERNAME = 'standin'
+EA_PASSWORD = 'standin'
+HOME = '1600 Pennsylvania St, Denver, CO 80203'
+WORK = '1701 Wynkoop St, Denver, CO 80202'
@@ -0,0 +1,71 @@
+"""
+Micro-benchmark for reading the detail page fields.
+
+Compares the old approach (a full html.parser tree plus one soup.find per
+field) with EALoader._scan_event_page (a strained tree read in one pass)
+on pages rendered from fixtures/event.html, and checks both read the same
+values:
+
+    python bench/parse_fields.py --pages 300
+"""
+import os
+import sys
+import time
+import argparse
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(1, os.path.dirname(HERE))
+
+from bs4 import BeautifulSoup
+
+import load
+import standin
+from fakemaps import FakeMaps
+from geocache import GeocodeCache
+from store import EventStore
+
+
+def find_per_field(ea, content):
+    """The extraction _extract_event_details used before the field schema."""
+    soup = BeautifulSoup(content, 'html.parser')
+    return dict((name, parser(soup.find(id=_id))) for name, (_id, parser) in ea._event_fields.items())
+
+
+def single_pass(ea, content):
+    field = ea._scan_event_page(content)
+    return dict((name, field(name)) for name in ea._event_fields)
+
+
+def rate(func, ea, pages, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        for content in pages:
+            func(ea, content)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(pages) / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--pages', type=int, default=300, help='distinct event pages to parse')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per variant; the best one counts')
+    args = parser.parse_args()
+
+    site = standin.Site(args.pages)
+    pages = [standin.render('event.html', **site.event(num)) for num in range(args.pages)]
+    ea = load.EALoader(maps=FakeMaps(), geocache=GeocodeCache(':memory:'), store=EventStore(':memory:'), run=False)
+
+    mismatched = sum(1 for content in pages if find_per_field(ea, content) != single_pass(ea, content))
+
+    before = rate(find_per_field, ea, pages, args.repeat)
+    after = rate(single_pass, ea, pages, args.repeat)
+    print('{:>28} {:>10}'.format('variant', 'pages/sec'))
+    print('{:>28} {:>10.1f}'.format('html.parser + soup.find', before))
+    print('{:>28} {:>10.1f}'.format('{} + strainer'.format(load.HTML_PARSER), after))
+    print('\nspeedup {:.1f}x, {} of {} pages read differently'.format(after / before, mismatched, len(pages)))
+
+
+if __name__ == '__main__':
+    main()
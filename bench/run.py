@@ -0,0 +1,205 @@
+"""
+Offline benchmark suite for the loaders.
+
+Runs every stage against the saved corpus, the fake Maps client and the
+stand-in info module, so it needs no network, browser or API key. Stages
+are timed separately and written as JSON for comparing versions:
+
+    python bench/run.py --label before
+    python bench/run.py --label after --compare bench/results/before.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import platform
+import subprocess
+from datetime import datetime
+from contextlib import contextmanager
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(1, ROOT)
+
+from bs4 import BeautifulSoup
+
+import load
+import load2
+import pipeline
+import corpus
+import ratelimit
+from fakemaps import FakeMaps
+from geocache import GeocodeCache
+from store import EventStore
+
+
+RESULTS = os.path.join(HERE, 'results')
+# Stages are timed without the production request rates
+LIMITS = dict(rates=ratelimit.UNLIMITED)
+
+
+@contextmanager
+def quiet():
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def timed(func, repeat):
+    """Run func `repeat` times; return its last result and the wall time of every run."""
+    result, times = None, []
+    for _ in range(repeat):
+        start = time.time()
+        with quiet():
+            result = func()
+        times.append(time.time() - start)
+    return result, times
+
+
+def record(stages, name, times, items):
+    best = min(times)
+    stages[name] = {
+        'items': items, 'best_seconds': round(best, 6), 'mean_seconds': round(sum(times) / len(times), 6),
+        'items_per_second': round(items / best, 1) if best else None,
+    }
+    print('{:<28} {:>8} {:>12.4f} {:>14}'.format(name, items, best, stages[name]['items_per_second']))
+
+
+def field_texts(pages):
+    """Raw strings the load2 parsers see, taken from the corpus event pages."""
+    texts = dict((key, []) for key in ('date', 'cost', 'limit', 'duration', 'description'))
+    for url, content in pages:
+        soup = BeautifulSoup(content, 'html.parser')
+        text = lambda _id: soup.find(id=_id).text.encode('utf-8').strip()
+        texts['date'].extend([text('contentMain_datetime'), text('contentMain_signupbefore')])
+        texts['cost'].extend([text('contentMain_venuecost'), text('contentMain_eventcost'), text('contentMain_eventtax')])
+        texts['limit'].append(text('contentMain_memberlimit'))
+        texts['duration'].append(text('contentMain_duration'))
+        name = text('contentMain_eventnamelocation')
+        texts['description'].append((name, text('contentMain_eventdescription'), text('contentMain_eventcost')))
+    return texts
+
+
+def run(args):
+    pages = corpus.pages('event')
+    stages = dict()
+    print('{:<28} {:>8} {:>12} {:>14}'.format('stage', 'items', 'best (s)', 'items/sec'))
+
+    # Parsers
+    ea2 = load2.EALoader(maps=FakeMaps(), geocache=GeocodeCache(':memory:'), store=EventStore(':memory:'),
+                         limits=ratelimit.default_limits(**LIMITS), run=False)
+    texts = field_texts(pages)
+    costed = [(name, description, ea2._parse_cost(cost)) for name, description, cost in texts['description']]
+    parsers = [
+        ('_parse_date', texts['date'], ea2._parse_date),
+        ('_parse_cost', texts['cost'], ea2._parse_cost),
+        ('_parse_limit', texts['limit'], ea2._parse_limit),
+        ('_parse_duration', texts['duration'], ea2._parse_duration),
+        ('_determine_cost', costed, lambda args: ea2._determine_cost(*args)),
+    ]
+    for name, values, parser in parsers:
+        values = values * args.scale
+        _, times = timed(lambda: [parser(value) for value in values], args.repeat)
+        record(stages, 'parse.{}'.format(name), times, len(values))
+
+    # Detail pages, with every address already geocoded so only parsing is timed
+    maps = FakeMaps(args.maps_latency)
+    ea = load.EALoader(maps=maps, geocache=GeocodeCache(':memory:'), store=EventStore(':memory:'),
+                      limits=ratelimit.default_limits(**LIMITS), run=False)
+    with quiet():
+        [ea._parse_event_page(content, url) for url, content in pages]
+    rows, times = timed(lambda: [ea._parse_event_page(content, url) for url, content in pages], args.repeat)
+    rows = [row for row in rows if row]
+    record(stages, 'parse.event_pages', times, len(pages))
+
+    # Enrichment: geocoding against a cold cache plus the distance matrix
+    addresses = [BeautifulSoup(content, 'html.parser').find(id='contentMain_venueaddress').text.strip()
+                 for url, content in pages]
+
+    def enrich():
+        ea._geocache = GeocodeCache(':memory:')
+        [ea._parse_address(address) for address in addresses]
+        return ea._add_travel_data(rows)
+    calls = sum(maps.calls.values())
+    enriched, times = timed(enrich, args.repeat)
+    record(stages, 'enrich', times, len(rows))
+    stages['enrich']['maps_calls'] = (sum(maps.calls.values()) - calls) // args.repeat
+
+    # DataFrame, read back from the streamed rows like a run does, and output files
+    directory, cwd = tempfile.mkdtemp(), os.getcwd()
+    os.chdir(directory)
+    try:
+        sink = pipeline.CsvSink(os.path.join(directory, 'rows.csv'), ea._output_fields)
+        sink.write(enriched)
+        sink.close()
+        ea._sink_path = sink.path
+        ea.dframe, times = timed(ea._produce_dataframe, args.repeat)
+        record(stages, 'produce_dataframe', times, len(rows))
+
+        _, times = timed(lambda: ea.write_files(all=True), args.repeat)
+        files = sum(len(names) for _, _, names in os.walk(os.path.join(directory, 'output')))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory)
+    record(stages, 'write_files', times, len(rows))
+    stages['write_files']['files'] = files
+
+    return stages
+
+
+def version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=ROOT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(stages, path):
+    with open(path) as f:
+        other = json.load(f)
+    print('\nCompared with {} ({})'.format(other.get('label'), other.get('version')))
+    print('{:<28} {:>12} {:>12} {:>9}'.format('stage', 'then (s)', 'now (s)', 'speedup'))
+    for name in sorted(set(stages) & set(other['stages'])):
+        then, now = other['stages'][name]['best_seconds'], stages[name]['best_seconds']
+        print('{:<28} {:>12.4f} {:>12.4f} {:>8.2f}x'.format(name, then, now, then / now if now else float('inf')))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--label', default=None, help='name of this run (defaults to the git version)')
+    parser.add_argument('--output', default=None, help='JSON file to write (defaults to bench/results/<label>.json)')
+    parser.add_argument('--compare', default=None, help='earlier JSON result to compare against')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per stage; the best one is reported')
+    parser.add_argument('--scale', type=int, default=20, help='times each parser input list is repeated')
+    parser.add_argument('--maps-latency', type=float, default=0.0, help='fake Maps call delay in seconds')
+    args = parser.parse_args()
+
+    if not corpus.pages('event'):
+        corpus.write(20)
+
+    stages = run(args)
+    label = args.label or version() or 'current'
+    result = {
+        'label': label, 'version': version(), 'created': datetime.now().isoformat(),
+        'python': platform.python_version(), 'html_parser': load.HTML_PARSER,
+        'maps_latency': args.maps_latency, 'repeat': args.repeat, 'stages': stages,
+    }
+    output = args.output or os.path.join(RESULTS, '{}.json'.format(label))
+    if not os.path.exists(os.path.dirname(os.path.abspath(output))):
+        os.makedirs(os.path.dirname(os.path.abspath(output)))
+    with open(output, 'w') as f:
+        json.dump(result, f, indent=2, sort_keys=True)
+    print('\nWrote {}'.format(output))
+
+    if args.compare:
+        compare(stages, args.compare)
+
+
+if __name__ == '__main__':
+    main()
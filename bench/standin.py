@@ -0,0 +1,218 @@
+"""
+Local stand-in for singles.eventsandadventures.com.
+
+Serves the logon page, the calendar (including the month postback) and
+generated event detail pages from the templates in fixtures/, so the
+loaders can be exercised and timed without touching the live site.
+
+    python bench/standin.py --port 8000 --events 60 --latency 0.05
+"""
+import os
+import sys
+import time
+import argparse
+import threading
+import itertools
+from calendar import monthrange
+from datetime import date, datetime, timedelta
+from urlparse import urlparse, parse_qs
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+MONTH_FIELD = 'ctl00$contentMain$lstmonths'
+AUTH_COOKIE = '.ASPXAUTH'
+
+VENUES = [
+    ('The Celtic Tavern', '1801 Blake St, Denver, CO 80202'),
+    ('Red Rocks Park', '18300 W Alameda Pkwy, Morrison, CO 80465'),
+    ('Lucky Strike', '500 16th St, Denver, CO 80202 (303) 555-0142'),
+    ('Chautauqua Park', '900 Baseline Rd, Boulder, CO 80302'),
+    ('Wash Park', '701 S Franklin St, Denver, CO 80209'),
+    ('Breckenridge Resort', '1599 Ski Hill Rd, Breckenridge, CO 80424'),
+    ('Garden of the Gods', '1805 N 30th St, Colorado Springs, CO 80904'),
+    ('Member Home', "We don't publish member addresses. Address emailed to those signed up"),
+]
+NAMES = ['Happy Hour', 'Hike', 'Bowling Night', 'Wine Tasting', 'Sand Volleyball', 'Ski Weekend',
+         'New Member Orientation', 'Trivia Night', 'Host Meeting', 'Salsa Lessons']
+SITES = ['Denver', 'Boulder', 'Colorado Springs']
+DURATIONS = ['2 hours', '3 hours', '1.5 hours', '2 nights', '1 day', '4+ hours']
+
+
+def render(fixture, **values):
+    with open(os.path.join(FIXTURES, fixture)) as f:
+        return f.read() % values
+
+
+def months(count=3, start=None):
+    today = start or date.today()
+    for num in range(count):
+        year, month = today.year + (today.month - 1 + num) // 12, (today.month - 1 + num) % 12 + 1
+        yield year, month
+
+
+def stamp(dt):
+    return '{} {} {}, {} {}:{:02d} {}'.format(dt.strftime('%A'), dt.strftime('%B'), dt.day, dt.year,
+                                              (dt.hour - 1) % 12 + 1, dt.minute, 'PM' if dt.hour >= 12 else 'AM')
+
+
+class Site(object):
+    """Deterministic set of events: `per_month` per calendar month from `start` on."""
+
+    def __init__(self, per_month, start=None):
+        self.per_month = per_month
+        self.start = start
+
+    def event(self, event_id):
+        month_idx, num = divmod(event_id, 1000)
+        year, month = list(months(month_idx + 1, self.start))[month_idx]
+        day = num % monthrange(year, month)[1] + 1
+        when = datetime(year, month, day, 12 + num % 9, 30 if num % 2 else 0)
+        venue, address = VENUES[num % len(VENUES)]
+        attending, limit = num % 23, (20 if num % 3 else 0)
+        cost = num % 6 * 7.5 if num % 10 != 5 else 1250
+        if num % 10 == 4:
+            description = 'Bring a friend! Drop-in games are $10.00 or ${:,.2f} for the season.'.format(cost)
+        else:
+            description = 'Join us at {}! Cost is ${:,.2f} per person.'.format(venue, cost)
+        return dict(
+            id=event_id, viewstate='dDwtMTA4NzczMzUxMjs7Pg' * 20,
+            name='{} #{}'.format(NAMES[num % len(NAMES)], num), location=venue,
+            sitename=SITES[num % len(SITES)], event_date=stamp(when),
+            event_status='Event is Full' if limit and attending >= limit else 'Space Available',
+            member_status='You are signed up' if num % 11 == 0 else 'Not Signed Up',
+            signup_before=stamp(when - timedelta(days=1)), cancel_before=stamp(when - timedelta(days=2)),
+            host='Jane Doe\nJohn Smith', event_type='Social', duration=DURATIONS[num % len(DURATIONS)],
+            attire='casual', venue_cost='${:.2f}'.format(num % 4 * 5), event_cost='${:,.2f}'.format(cost),
+            event_tax='${:.2f}'.format(cost * 0.08), address=address,
+            memberlimit='{} attending / {} limit'.format(attending, limit or 'no'), description=description,
+        )
+
+    def calendar(self, month_idx):
+        shown = list(months(month_idx + 1, self.start))[month_idx]
+        options = '\n'.join('    <option {}value="{}/1/{}">{}</option>'.format(
+            'selected="selected" ' if (y, m) == shown else '', m, y, date(y, m, 1).strftime('%B %Y'))
+            for y, m in months(6, self.start))
+        days = []
+        for num in range(self.per_month):
+            event = self.event(month_idx * 1000 + num)
+            days.append('    <tr><td class="calday"><span class="daynum">{}</span>'
+                        '<a class="calevent" href="event.aspx?id={}">{}</a></td></tr>'.format(
+                            num % monthrange(*shown)[1] + 1, event['id'], event['name']))
+        return render('calendar.html', viewstate='dDwxNTk0OTEyMjs7Pg' * 40, validation='/wEWAgKO' * 4,
+                      options=options, days='\n'.join(days))
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body='', headers=()):
+        time.sleep(self.server.latency)
+        self.send_response(status)
+        for key, value in headers:
+            self.send_header(key, value)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.count(urlparse(self.path).path)
+
+    def _authorized(self):
+        cookies = [part.strip().split('=', 1) for part in (self.headers.getheader('Cookie') or '').split(';')]
+        return any(len(pair) == 2 and pair[0] == AUTH_COOKIE and pair[1] in self.server.tokens for pair in cookies)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        page = url.path.rsplit('/', 1)[-1]
+        if page == 'logon.aspx':
+            return self._send(200, render('logon.html', viewstate='dDwtOTk2ODk2NTk7Oz4' * 10, validation='/wEWBAK'))
+        if not self._authorized():
+            return self._send(302, headers=[('Location', 'logon.aspx')])
+        if page == 'calendar.aspx':
+            return self._send(200, self.server.site.calendar(0))
+        if page in ('event.aspx', 'signup.aspx'):
+            return self._send(200, render('event.html', **self.server.site.event(int(query['id'][0]))))
+        self._send(404, 'Not Found')
+
+    def do_POST(self):
+        page = urlparse(self.path).path.rsplit('/', 1)[-1]
+        form = parse_qs(self.rfile.read(int(self.headers.getheader('Content-Length') or 0)))
+        if page == 'logon.aspx':
+            cookie = '{}={}; path=/'.format(AUTH_COOKIE, self.server.new_token())
+            return self._send(302, headers=[('Location', 'calendar.aspx'), ('Set-Cookie', cookie)])
+        if not self._authorized():
+            return self._send(302, headers=[('Location', 'logon.aspx')])
+        if page == 'calendar.aspx':
+            value = form.get(MONTH_FIELD, [''])[0]
+            for idx, (year, month) in enumerate(months(6, self.server.site.start)):
+                if value == '{}/1/{}'.format(month, year):
+                    return self._send(200, self.server.site.calendar(idx))
+            return self._send(200, self.server.site.calendar(0))
+        self._send(404, 'Not Found')
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, address, site, latency=0.0):
+        HTTPServer.__init__(self, address, Handler)
+        self.site = site
+        self.latency = latency
+        self.hits = dict()
+        self.tokens = set()
+        self._token_ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def count(self, path):
+        with self._lock:
+            self.hits[path] = self.hits.get(path, 0) + 1
+
+    def new_token(self):
+        with self._lock:
+            token = 'standin{}'.format(next(self._token_ids))
+            self.tokens.add(token)
+            return token
+
+    def expire_sessions(self):
+        """Log every client out, as the site does when its auth cookie times out."""
+        with self._lock:
+            self.tokens.clear()
+
+    @property
+    def login_url(self):
+        return 'http://{}:{}/website/logon.aspx'.format(*self.server_address)
+
+
+def serve(port=0, events=60, latency=0.0):
+    """Start a stand-in server on a background thread and return it."""
+    server = StandInServer(('127.0.0.1', port), Site(events), latency)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--events', type=int, default=60, help='events per calendar month')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    args = parser.parse_args()
+
+    server = StandInServer(('127.0.0.1', args.port), Site(args.events), args.latency)
+    print('Serving {}'.format(server.login_url))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
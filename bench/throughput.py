@@ -0,0 +1,94 @@
+"""
+Compare the serial, threaded and gevent loaders against the stand-in site.
+
+Each engine runs in its own interpreter (gevent patches the process it is
+imported into) against one shared stand-in server:
+
+    python bench/throughput.py --events 60 --latency 0.05 --maps-latency 0.02
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(1, os.path.dirname(HERE))
+
+MODES = ('serial', 'threaded', 'gevent')
+
+
+def run(mode, url, args):
+    """Build one loader against `url` and report what it did."""
+    if mode == 'gevent':
+        from crawl import EACrawler as Loader
+        kwargs = dict(concurrency=args.concurrency, per_host=args.per_host)
+        cap = args.per_host
+    else:
+        from load import EALoader as Loader
+        kwargs = dict(workers=args.workers if mode == 'threaded' else None)
+        cap = args.workers if mode == 'threaded' else 1
+
+    # Compare the engines, not the production request rates
+    import ratelimit
+    kwargs['limits'] = ratelimit.default_limits(cap, rates=ratelimit.UNLIMITED)
+
+    from fakemaps import FakeMaps
+    from geocache import GeocodeCache
+    from store import EventStore
+
+    # The loader streams its rows to output/ under the working directory
+    devnull = open(os.devnull, 'w')
+    stdout, sys.stdout = sys.stdout, devnull
+    directory, cwd = tempfile.mkdtemp(), os.getcwd()
+    os.chdir(directory)
+    try:
+        start = time.time()
+        maps = FakeMaps(args.maps_latency)
+        ea = Loader(login_url=url, maps=maps, geocache=GeocodeCache(':memory:'), store=EventStore(':memory:'), **kwargs)
+        elapsed = time.time() - start
+    finally:
+        sys.stdout = stdout
+        os.chdir(cwd)
+        shutil.rmtree(directory)
+    return {'mode': mode, 'links': len(ea._events), 'rows': ea._rows, 'seconds': round(elapsed, 3),
+            'pages_per_second': round(len(ea._events) / elapsed, 1), 'maps_calls': sum(maps.calls.values())}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--events', type=int, default=60, help='events per calendar month')
+    parser.add_argument('--latency', type=float, default=0.05, help='stand-in response delay in seconds')
+    parser.add_argument('--maps-latency', type=float, default=0.02, help='fake Maps call delay in seconds')
+    parser.add_argument('--workers', type=int, default=8, help='threads for the threaded loader')
+    parser.add_argument('--concurrency', type=int, default=200, help='greenlets for the gevent loader')
+    parser.add_argument('--per-host', type=int, default=20, help='in-flight requests per host for gevent')
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=list(MODES))
+    parser.add_argument('--mode', choices=MODES, help=argparse.SUPPRESS)
+    parser.add_argument('--url', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode:
+        print(json.dumps(run(args.mode, args.url, args)))
+        return
+
+    import standin
+    server = standin.serve(events=args.events, latency=args.latency)
+    results = []
+    for mode in args.modes:
+        cmd = [sys.executable, os.path.abspath(__file__), '--mode', mode, '--url', server.login_url] + sys.argv[1:]
+        out = subprocess.check_output(cmd)
+        results.append(json.loads(out.strip().splitlines()[-1]))
+
+    print('{:>10} {:>6} {:>6} {:>9} {:>11} {:>10}'.format('mode', 'links', 'rows', 'seconds', 'pages/sec', 'maps calls'))
+    for res in results:
+        print('{mode:>10} {links:>6} {rows:>6} {seconds:>9} {pages_per_second:>11} {maps_calls:>10}'.format(**res))
+    if len(set(res['rows'] for res in results)) > 1:
+        print('\nWARNING: engines produced different row counts')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+
+import threading
+from Queue import Queue
+from contextlib import contextmanager
+from multiprocessing.dummy import Pool as ThreadPool
+
+from selenium import webdriver
+from selenium.common.exceptions import WebDriverException
+
+import pipeline
+
+
+def chrome_options(headless=True, images=False):
+    options = webdriver.ChromeOptions()
+    if headless:
+        options.add_argument('--headless')
+        options.add_argument('--disable-gpu')
+        options.add_argument('--window-size=1280,1024')
+    if not images:
+        # Event pages are read for their text; skipping images saves most of each page load
+        options.add_argument('--blink-settings=imagesEnabled=false')
+        options.add_experimental_option('prefs', {'profile.managed_default_content_settings.images': 2})
+    return options
+
+
+def healthy(driver):
+    """True while the browser still answers WebDriver commands."""
+    try:
+        driver.current_url
+        return True
+    except WebDriverException:
+        return False
+
+
+def _quit(driver):
+    try:
+        driver.quit()
+    except WebDriverException:
+        pass
+
+
+class _Worker(object):
+
+    def __init__(self, driver):
+        self.driver = driver
+        self.tasks = 0
+
+
+class BrowserPool(object):
+    """Up to `size` logged-in browsers shared by worker threads.
+
+    factory() starts a browser and logs it in; it is called lazily, once
+    per worker, and again when a worker is replaced. A worker is replaced
+    before its next task when it no longer answers (health check) or has
+    served `max_tasks` tasks, which keeps Chrome's memory from growing
+    over a long run.
+    """
+
+    def __init__(self, factory, size=4, max_tasks=100, metrics=None):
+        self._factory = factory
+        self.size = size
+        self._max_tasks = max_tasks
+        self._metrics = metrics
+        self._idle = Queue()
+        self._lock = threading.Lock()
+        self._started = 0
+        self._workers = []
+
+    def _start(self):
+        if self._metrics:
+            with self._metrics.timer('browser_login'):
+                return _Worker(self._factory())
+        return _Worker(self._factory())
+
+    def _replace(self, worker, reason):
+        if self._metrics:
+            self._metrics.count('browser_restarts', reason=reason)
+        _quit(worker.driver)
+        with self._lock:
+            self._workers.remove(worker)
+        return self._add()
+
+    def _add(self):
+        try:
+            worker = self._start()
+        except Exception:
+            with self._lock:
+                self._started -= 1
+            raise
+        with self._lock:
+            self._workers.append(worker)
+        return worker
+
+    def _acquire(self):
+        with self._lock:
+            start = self._idle.empty() and self._started < self.size
+            if start:
+                self._started += 1
+        if start:
+            return self._add()
+        worker = self._idle.get()
+        if worker.tasks >= self._max_tasks:
+            return self._replace(worker, 'recycled')
+        if not healthy(worker.driver):
+            return self._replace(worker, 'unhealthy')
+        return worker
+
+    @contextmanager
+    def driver(self):
+        """A logged-in driver for the duration of one task."""
+        worker = self._acquire()
+        try:
+            yield worker.driver
+        finally:
+            worker.tasks += 1
+            self._idle.put(worker)
+
+    def map(self, func, items, window=None):
+        """Yield func(driver, item) for every item, in order, with the items spread across the pool.
+
+        A task whose browser died under it runs once more on another worker.
+        """
+        def call(item):
+            for attempt in range(2):
+                with self.driver() as driver:
+                    try:
+                        return func(driver, item)
+                    except WebDriverException:
+                        if attempt or healthy(driver):
+                            raise
+
+        threads = ThreadPool(self.size)
+        try:
+            for result in pipeline.ordered(threads, call, items, window or 2 * self.size):
+                yield result
+        finally:
+            threads.close()
+
+    def close(self):
+        with self._lock:
+            workers, self._workers = self._workers, []
+        for worker in workers:
+            _quit(worker.driver)
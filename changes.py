@@ -0,0 +1,184 @@
+"""
+What changed in the events since the previous loader run.
+
+    python changes.py
+    python changes.py --kinds status,attendees
+
+Prints output/changes.csv, the delta each loader run writes next to the
+events CSV: new and removed events, status flips, attendee and spots
+changes and price changes.
+"""
+import os
+import json
+import hashlib
+import argparse
+from collections import namedtuple, OrderedDict
+from datetime import datetime
+
+import pandas as pd
+
+import pipeline
+
+
+# Fields whose changes are reported, by kind of change; a loader tracks the ones it has
+TRACKED = OrderedDict([
+    ('status', ['event_status', 'member_status']),
+    ('attendees', ['attendees', 'spots_left', 'limit']),
+    ('price', ['event_cost', 'event_tax', 'venue_cost']),
+])
+
+# Kinds that mean an event may need a decision again; 'removed' and 'passed' do not
+ACTIONABLE = ('new', 'status', 'attendees', 'price')
+
+Change = namedtuple('Change', ['change', 'url', 'event_name', 'event_date', 'field', 'before', 'after'])
+
+
+def _text(value):
+    # Decimals, counts and dates compare by what the CSV shows
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return unicode(value)
+
+
+def _digest(values):
+    return hashlib.sha1(json.dumps(values)).hexdigest()
+
+
+class Snapshot(object):
+    """Per event URL: the hash of its tracked fields, the fields themselves, its name and date."""
+
+    def __init__(self, fields, events=None):
+        self.fields = fields
+        self.events = events or dict()
+
+    @classmethod
+    def for_columns(cls, columns):
+        """Empty snapshot tracking the fields of TRACKED that rows of `columns` have."""
+        return cls([col for cols in TRACKED.values() for col in cols if col in columns])
+
+    @classmethod
+    def from_rows(cls, rows, columns):
+        return cls.for_columns(columns).add(rows, columns)
+
+    def add(self, rows, columns):
+        field = columns.index
+        for row in rows:
+            values = [_text(row[field(col)]) for col in self.fields]
+            self.events[row[field('url')]] = {'hash': _digest(values), 'values': values,
+                                              'name': _text(row[field('event_name')]),
+                                              'date': _text(row[field('event_date')])}
+        return self
+
+    @classmethod
+    def load(cls, path):
+        """The snapshot saved at path, or None before the first run."""
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            saved = json.load(f)
+        return cls(saved['fields'], saved['events'])
+
+    def save(self, path):
+        # Written aside and renamed, so an interrupted run leaves the previous snapshot intact
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'fields': self.fields, 'events': self.events}, f, separators=(',', ':'))
+        os.rename(path + '.tmp', path)
+
+    def carry(self, previous, urls):
+        """Keep previous's entries for `urls`, events this run could not read, so they are not reported removed."""
+        if previous is not None and previous.fields == self.fields:
+            for url in urls:
+                if url in previous.events and url not in self.events:
+                    self.events[url] = previous.events[url]
+        return self
+
+
+def diff(previous, current, now=None):
+    """Changes from the previous snapshot to the current one.
+
+    Events whose hashes match are skipped without looking at their fields.
+    A removed event dated before `now` is reported as 'passed'. Without a
+    previous snapshot (or one that tracked other fields) every event is new.
+    """
+    now = _text(now or datetime.now())
+    changes = []
+    before = previous.events if previous is not None and previous.fields == current.fields else dict()
+    kinds = dict((col, kind) for kind, cols in TRACKED.items() for col in cols)
+
+    for url in sorted(current.events):
+        event = current.events[url]
+        old = before.get(url)
+        if old is None:
+            changes.append(Change('new', url, event['name'], event['date'], None, None, None))
+            continue
+        if old['hash'] == event['hash']:
+            continue
+        for col, old_value, new_value in zip(current.fields, old['values'], event['values']):
+            if old_value != new_value:
+                changes.append(Change(kinds[col], url, event['name'], event['date'], col, old_value, new_value))
+
+    for url in sorted(set(before) - set(current.events)):
+        event = before[url]
+        kind = 'passed' if event['date'] and event['date'] < now else 'removed'
+        changes.append(Change(kind, url, event['name'], event['date'], None, None, None))
+    return changes
+
+
+def summary(changes):
+    counts = OrderedDict((kind, 0) for kind in ('new',) + tuple(TRACKED) + ('removed', 'passed'))
+    for kind, url in set((change.change, change.url) for change in changes):
+        counts[kind] += 1
+    return counts
+
+
+def write(changes, path):
+    sink = pipeline.CsvSink(path, Change._fields)
+    try:
+        sink.write(changes)
+    finally:
+        sink.close()
+
+
+def update(current, base, failed=()):
+    """Diff the current snapshot against base/snapshot.json, write base/changes.csv and save it in its place."""
+    path = os.path.join(base, 'snapshot.json')
+    previous = Snapshot.load(path)
+    current.carry(previous, failed)
+    changes = diff(previous, current)
+    write(changes, os.path.join(base, 'changes.csv'))
+    current.save(path)
+    return changes
+
+
+def report(current, base, failed=()):
+    """update(), printing how many events changed in each way."""
+    found = update(current, base, failed)
+    print('-> Changes: {}'.format(', '.join('{} {}'.format(count, kind)
+                                             for kind, count in summary(found).items() if count) or 'none'))
+    return found
+
+
+def changed_urls(path, kinds=ACTIONABLE):
+    """URLs of the events in a changes CSV with a change of one of `kinds`."""
+    df = pd.read_csv(path, usecols=['change', 'url'])
+    return set(df.url[df.change.isin(kinds)])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter, epilog=__doc__)
+    parser.add_argument('--csv', default=None, help='changes CSV (defaults to output/changes.csv)')
+    parser.add_argument('--kinds', default=None, help='comma separated kinds of change to print')
+    args = parser.parse_args()
+
+    df = pd.read_csv(args.csv or os.path.join(os.getcwd(), 'output', 'changes.csv'))
+    if args.kinds:
+        df = df[df.change.isin(args.kinds.split(','))]
+    columns = ['change', 'event_date', 'event_name', 'field', 'before', 'after']
+    print(df[columns].fillna('').to_string(index=False) if len(df) else 'No changes')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+
+import pandas as pd
+
+# pyarrow is only needed for the Parquet copy of the output
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa, pq = None, None
+
+
+CATEGORY_COLUMNS = ['sitename', 'city', 'state', 'event_status', 'member_status', 'event_day']
+MONEY_COLUMNS = ['event_cost', 'event_tax', 'venue_cost']
+DATE_COLUMNS = ['event_date', 'signup_before', 'cancel_before']
+COUNT_COLUMNS = ['spots_left', 'attendees', 'limit', 'time_from_home', 'time_from_work']
+FLOAT_COLUMNS = ['duration', 'dist_from_home', 'dist_from_work', 'latitude', 'longitude']
+
+
+def available():
+    return pa is not None
+
+
+def _text(values):
+    # Python 2 rows mix utf-8 byte strings and unicode; Arrow wants one of them
+    return values.map(lambda v: v.decode('utf-8', 'replace') if isinstance(v, str) else v)
+
+
+def to_cents(values):
+    return (pd.to_numeric(values, errors='coerce') * 100).round().astype('Int64')
+
+
+def to_dollars(cents):
+    # Exact for any amount the site could show; missing prices stay empty
+    return (cents.astype(float) / 100).map(lambda v: '{:.2f}'.format(v) if v == v else None)
+
+
+def numeric(df, columns=None):
+    """Replace the Decimal columns of a loader frame with numbers, in place.
+
+    Money becomes integer cents, counts and minutes nullable int32 and
+    hours and miles floats.
+    """
+    columns = columns or MONEY_COLUMNS + COUNT_COLUMNS + FLOAT_COLUMNS
+    for col in columns:
+        if col not in df or str(df[col].dtype).startswith('Int'):
+            continue
+        if col in MONEY_COLUMNS:
+            df[col] = to_cents(df[col])
+        elif col in COUNT_COLUMNS:
+            df[col] = pd.to_numeric(df[col], errors='coerce').round().astype('Int32')
+        else:
+            df[col] = pd.to_numeric(df[col], errors='coerce').astype(float)
+    return df
+
+
+def readable(df):
+    """Copy of a numeric() frame with the cents written back out as dollars, for the CSV files."""
+    df = df.copy()
+    for col in MONEY_COLUMNS:
+        if col in df:
+            df[col] = to_dollars(df[col])
+    return df
+
+
+def compact(df):
+    """Copy of an events frame with categoricals, numeric() columns and real timestamps.
+
+    Works on the loader's frame as well as on one read back from the CSV
+    (dollar amounts and date strings).
+    """
+    df = df.copy()
+    for col in df.columns:
+        if df[col].dtype == object:
+            df[col] = _text(df[col])
+    for col in CATEGORY_COLUMNS:
+        if col in df:
+            df[col] = df[col].astype('category')
+    for col in DATE_COLUMNS:
+        if col in df:
+            df[col] = pd.to_datetime(df[col])
+    return numeric(df)
+
+
+def write(df, path):
+    """Write a compact() frame to Parquet, storing the nullable integer columns as int32."""
+    ints = [col for col in df.columns if str(df[col].dtype).startswith('Int')]
+    plain = df.copy()
+    for col in ints:
+        plain[col] = plain[col].astype(float)
+    table = pa.Table.from_pandas(plain, preserve_index=False)
+    fields = [pa.field(f.name, pa.int32()) if f.name in ints else f for f in table.schema]
+    pq.write_table(table.cast(pa.schema(fields, metadata=table.schema.metadata)), path)
+
+
+def _arrow_type(col):
+    if col in DATE_COLUMNS:
+        return pa.timestamp('ns')
+    if col in MONEY_COLUMNS + COUNT_COLUMNS:
+        return pa.int32()
+    if col in FLOAT_COLUMNS:
+        return pa.float64()
+    return pa.string()
+
+
+def write_chunks(frames, path):
+    """Write compact() frames to one Parquet file, a frame at a time.
+
+    Every frame is cast to the types the column lists above give, so a frame
+    whose column happens to be empty still matches the others. Categories are
+    stored as plain text; read() turns them back into categories.
+    """
+    writer = None
+    try:
+        for df in frames:
+            plain = df.copy()
+            for col in plain.columns:
+                if str(plain[col].dtype) == 'category':
+                    plain[col] = plain[col].astype(object)
+                elif str(plain[col].dtype).startswith('Int'):
+                    plain[col] = plain[col].astype(float)
+            table = pa.Table.from_pandas(plain, preserve_index=False)
+            if writer is None:
+                schema = pa.schema([pa.field(col, _arrow_type(col)) for col in plain.columns],
+                                   metadata=table.schema.metadata)
+                writer = pq.ParquetWriter(path, schema)
+            writer.write_table(table.cast(schema))
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def read(path):
+    df = pq.read_table(path).to_pandas()
+    for col in CATEGORY_COLUMNS:
+        if col in df and df[col].dtype == object:
+            df[col] = df[col].astype('category')
+    for col in MONEY_COLUMNS + COUNT_COLUMNS:
+        if col in df:
+            df[col] = df[col].astype('Int64' if col in MONEY_COLUMNS else 'Int32')
+    return df
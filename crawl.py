@@ -0,0 +1,101 @@
+
+# gevent has to patch the standard library before requests is imported
+from gevent import monkey
+monkey.patch_all()
+
+import os
+from collections import defaultdict
+from urlparse import urlparse
+
+from gevent.pool import Pool
+from gevent.lock import BoundedSemaphore
+
+import requests
+
+import discovery
+import pipeline
+import ratelimit
+from load import EALoader
+
+
+# Host the googlemaps client talks to; every Maps lookup shares its limit
+MAPS_HOST = 'maps.googleapis.com'
+
+
+class HostLimitedSession(requests.Session):
+    """requests.Session that allows at most `limit` requests in flight per host."""
+
+    def __init__(self, limit):
+        super(HostLimitedSession, self).__init__()
+        self._limits = defaultdict(lambda: BoundedSemaphore(limit))
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=limit)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+
+    def host_limit(self, host):
+        return self._limits[host]
+
+    def request(self, method, url, *args, **kwargs):
+        with self._limits[urlparse(url).netloc]:
+            return super(HostLimitedSession, self).request(method, url, *args, **kwargs)
+
+
+class EACrawler(EALoader):
+    """EALoader driven by greenlets on a single thread.
+
+    Login, calendar discovery, detail pages and Maps lookups all run
+    cooperatively; parsing and filtering are inherited from EALoader so the
+    rows are identical to EALoader._iter_event_details.
+    """
+
+    def __init__(self, concurrency=200, per_host=20, **kwargs):
+        self._concurrency = concurrency
+        self._session = HostLimitedSession(per_host)
+        archive = kwargs.get('archive')
+        limits = ratelimit.replay_limits if archive and archive.replaying else ratelimit.default_limits
+        kwargs.setdefault('limits', limits(per_host))
+        run = kwargs.pop('run', True)
+        super(EACrawler, self).__init__(run=False, **kwargs)
+        # The archive has to be on the session before the crawl starts
+        if archive:
+            self._mount(self._session, pool_connections=4, pool_maxsize=per_host)
+        if run:
+            self._run()
+
+
+    def _get_event_links(self):
+        # Login and land on the calendar without a browser
+        calendar = self._sessions.calendar(self._session)
+
+        # Every month posts back from the same calendar state, so they can run together
+        entries = discovery.discover(self._session, calendar, self._months, Pool(self._concurrency))
+        return self._rules.links(entries, self._metrics)
+
+
+    def _iter_event_details(self):
+        pool = Pool(self._concurrency)
+        extract = lambda link: self._extract_event(self._session, link)
+        for items in pipeline.ordered(pool, extract, self._events, self._concurrency):
+            if items:
+                yield items
+
+
+    def _parse_address(self, addr):
+        with self._session.host_limit(MAPS_HOST):
+            return super(EACrawler, self)._parse_address(addr)
+
+
+    def _extract_travel_data(self, origins, destinations):
+        with self._session.host_limit(MAPS_HOST):
+            return super(EACrawler, self)._extract_travel_data(origins, destinations)
+
+
+def main():
+    ea = EACrawler()
+    ea.write_files()
+    ea.write_report()
+
+
+if __name__ == '__main__':
+    os.system('clear')
+    main()
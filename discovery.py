@@ -0,0 +1,178 @@
+
+from datetime import date
+from collections import namedtuple
+from urllib import urlencode
+from urlparse import urljoin, urlsplit, urlunsplit, parse_qsl
+from multiprocessing.dummy import Pool as ThreadPool
+
+from bs4 import BeautifulSoup
+
+
+# ASP.NET control that switches the calendar month through a postback
+MONTH_SELECT_ID = 'contentMain_lstmonths'
+CALENDAR_LINK_ID = 'PublicNav1_lnkCalendar'
+
+# What the calendar itself tells about an event; day is None when it cannot be read
+CalendarEntry = namedtuple('CalendarEntry', ['url', 'title', 'day'])
+
+
+def form_fields(soup):
+    """Return the form action and every field a browser would post back.
+
+    Hidden ASP.NET state (__VIEWSTATE, __EVENTVALIDATION, ...) is carried
+    over as-is; buttons and unchecked boxes are left out just like a browser.
+    """
+    form = soup.find('form')
+    fields = dict()
+    for inp in form.find_all('input'):
+        name = inp.get('name')
+        kind = (inp.get('type') or 'text').lower()
+        if not name or kind in ('submit', 'button', 'image', 'reset'):
+            continue
+        if kind in ('checkbox', 'radio') and not inp.has_attr('checked'):
+            continue
+        fields[name] = inp.get('value') or ''
+    for select in form.find_all('select'):
+        option = select.find('option', selected=True) or select.find('option')
+        if select.get('name') and option is not None:
+            fields[select.get('name')] = option.get('value')
+    return form.get('action') or '', fields
+
+
+def login(session, login_url, username, password):
+    """Post the logon form and return the calendar page for the new session."""
+    return open_calendar(session, sign_in(session, login_url, username, password))
+
+
+def sign_in(session, login_url, username, password):
+    """Post the logon form and return the page the site lands on."""
+    res = session.get(login_url)
+    soup = BeautifulSoup(res.content, 'html.parser')
+    action, fields = form_fields(soup)
+    for inp in soup.find('form').find_all('input'):
+        _id = inp.get('id') or ''
+        if 'username' in _id:
+            fields[inp.get('name')] = username
+        elif 'password' in _id:
+            fields[inp.get('name')] = password
+        elif 'btnSubmit' in _id:
+            fields[inp.get('name')] = inp.get('value')
+    return session.post(urljoin(res.url, action), data=fields)
+
+
+def postback(session, response, control_id, value):
+    """Replay the __doPostBack a browser fires when control_id changes to value."""
+    soup = BeautifulSoup(response.content, 'html.parser')
+    action, fields = form_fields(soup)
+    name = soup.find(id=control_id).get('name')
+    fields.update({'__EVENTTARGET': name, '__EVENTARGUMENT': '', name: value})
+    return session.post(urljoin(response.url, action), data=fields)
+
+
+def event_links(response):
+    return [entry.url for entry in event_entries(response)]
+
+
+def event_entries(response, year=None, month=None):
+    return page_entries(response.content, response.url, year, month)
+
+
+def page_entries(content, base_url, year=None, month=None):
+    """Return a CalendarEntry per calevent link, dated from its cell's day number when year and month are given."""
+    soup = BeautifulSoup(content, 'html.parser')
+    entries = []
+    for a in soup.find_all('a', class_='calevent'):
+        if not a.get('href'):
+            continue
+        cell = a.find_parent('td')
+        daynum = cell.find(class_='daynum') if cell is not None else None
+        day = None
+        if year and month and daynum is not None and daynum.text.strip().isdigit():
+            day = date(year, month, int(daynum.text.strip()))
+        entries.append(CalendarEntry(urljoin(base_url, a.get('href')), a.text.strip(), day))
+    return entries
+
+
+def open_calendar(session, response):
+    """Follow the navigation link to the calendar unless response already is it."""
+    soup = BeautifulSoup(response.content, 'html.parser')
+    if soup.find(id=MONTH_SELECT_ID) is not None:
+        return response
+    link = soup.find(id=CALENDAR_LINK_ID)
+    return session.get(urljoin(response.url, link.get('href')))
+
+
+def month_value(year, month):
+    return '{}/1/{}'.format(month, year)
+
+
+def horizon(months=3, until=None, today=None):
+    """(year, month) pairs from the current month on: `months` of them, or every month up to the date `until`."""
+    today = today or date.today()
+    year, month = today.year, today.month
+    result = []
+    while (until is None and len(result) < months) or (until is not None and (year, month) <= (until.year, until.month)):
+        result.append((year, month))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return result
+
+
+def offered_months(content):
+    """Month values the calendar's month list offers, in the format of month_value."""
+    select = BeautifulSoup(content, 'html.parser').find(id=MONTH_SELECT_ID)
+    if select is None:
+        return set()
+    return set(option.get('value') for option in select.find_all('option'))
+
+
+def canonical_url(url):
+    """Lowercase scheme and host, query parameters in order and no fragment, so one event has one URL."""
+    scheme, netloc, path, query, fragment = urlsplit(url)
+    return urlunsplit((scheme.lower(), netloc.lower(), path or '/', urlencode(sorted(parse_qsl(query, True))), ''))
+
+
+def unique_entries(entries):
+    """Entries with canonical URLs, keeping the first of any URL listed more than once."""
+    seen = set()
+    result = []
+    for entry in entries:
+        url = canonical_url(entry.url)
+        if url not in seen:
+            seen.add(url)
+            result.append(entry._replace(url=url))
+    return result
+
+
+def discover(session, calendar, months, pool=None):
+    """Unique CalendarEntry list of every month in months, one postback per month run concurrently.
+
+    Each postback replays the state of the same calendar page, so the months
+    do not depend on each other. Months the calendar does not offer yet are
+    left out. pool defaults to one thread per month.
+    """
+    offered = offered_months(calendar.content)
+    months = [(year, month) for year, month in months if not offered or month_value(year, month) in offered]
+    if not months:
+        return []
+    fetch = lambda year_month: month_entries(session, calendar, *year_month)
+    own = pool is None
+    pool = pool or ThreadPool(len(months))
+    try:
+        return unique_entries(entry for entries in pool.imap(fetch, months) for entry in entries)
+    finally:
+        if own:
+            pool.close()
+
+
+def month_links(session, calendar, year, month):
+    """Return the calevent links of a month, switching the calendar to it if needed."""
+    return [entry.url for entry in month_entries(session, calendar, year, month)]
+
+
+def month_entries(session, calendar, year, month):
+    value = month_value(year, month)
+    select = BeautifulSoup(calendar.content, 'html.parser').find(id=MONTH_SELECT_ID)
+    selected = select.find('option', selected=True) if select is not None else None
+    if selected is None or selected.get('value') != value:
+        calendar = postback(session, calendar, MONTH_SELECT_ID, value)
+    return event_entries(calendar, year, month)
@@ -0,0 +1,100 @@
+
+import os
+import re
+import json
+import time
+import sqlite3
+import threading
+
+
+class GeocodeCache(object):
+    """Disk backed cache for googlemaps geocode results.
+
+    Entries are keyed by a normalized address and expire after `ttl`
+    seconds. Empty results are stored too (for `negative_ttl` seconds) so
+    addresses that never resolve stop costing API calls. Once the table
+    holds more than `max_entries`, the least recently used rows are dropped.
+    """
+
+    def __init__(self, path, ttl=90 * 86400, negative_ttl=30 * 86400, max_entries=5000):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._ttl = ttl
+        self._negative_ttl = negative_ttl
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS geocode ('
+            'address TEXT PRIMARY KEY, result TEXT NOT NULL, created REAL NOT NULL, used REAL NOT NULL)'
+        )
+        self._conn.commit()
+        self.hits, self.negative_hits, self.misses = 0, 0, 0
+
+
+    @staticmethod
+    def normalize(address):
+        if isinstance(address, str):
+            address = address.decode('utf-8', 'replace')
+        return u' '.join(re.sub(r'[^\w\s]', u' ', address.lower(), flags=re.UNICODE).split())
+
+
+    def get(self, address):
+        """Return the cached result (possibly []) or None when it has to be looked up."""
+        key, now = self.normalize(address), time.time()
+        with self._lock:
+            row = self._conn.execute('SELECT result, created FROM geocode WHERE address = ?', (key,)).fetchone()
+            if row is not None:
+                result = json.loads(row[0])
+                if now - row[1] < (self._ttl if result else self._negative_ttl):
+                    self._conn.execute('UPDATE geocode SET used = ? WHERE address = ?', (now, key))
+                    self._conn.commit()
+                    if result:
+                        self.hits += 1
+                    else:
+                        self.negative_hits += 1
+                    return result
+            self.misses += 1
+        return None
+
+
+    def unresolved(self, address):
+        """True when the last lookup of address found nothing, however long ago.
+
+        Unlike get() this neither expires the answer nor counts as a hit or miss.
+        """
+        with self._lock:
+            row = self._conn.execute('SELECT result FROM geocode WHERE address = ?',
+                                     (self.normalize(address),)).fetchone()
+        return row is not None and not json.loads(row[0])
+
+
+    def set(self, address, result):
+        key, now = self.normalize(address), time.time()
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO geocode VALUES (?, ?, ?, ?)',
+                               (key, json.dumps(result or []), now, now))
+            excess = self._conn.execute('SELECT COUNT(*) FROM geocode').fetchone()[0] - self._max_entries
+            if excess > 0:
+                self._conn.execute('DELETE FROM geocode WHERE address IN '
+                                   '(SELECT address FROM geocode ORDER BY used LIMIT ?)', (excess,))
+            self._conn.commit()
+
+
+    def geocode(self, client, address):
+        """client.geocode(address), answered from the cache whenever possible."""
+        result = self.get(address)
+        if result is None:
+            result = client.geocode(address)
+            self.set(address, result)
+        return result
+
+
+    def stats(self):
+        return {'hits': self.hits, 'negative_hits': self.negative_hits, 'misses': self.misses}
+
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -1,13 +1,32 @@
 
 import os
 import re
-from datetime import date, datetime
-from shutil import rmtree
+import time
+import threading
+import argparse
+from datetime import datetime
+from itertools import imap
+from multiprocessing.dummy import Pool as ThreadPool
 from cdecimal import Decimal
 import googlemaps
 
 import requests
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
+
+import discovery
+from geocache import GeocodeCache
+import nearby
+from store import EventStore, VOLATILE_SKIPS, content_hash, stale_reason
+from partition import write_partitions, clear_partitions
+import columnar
+import changes
+import pipeline
+from metrics import Metrics, timed
+import profiling
+import ratelimit
+import prefilter
+from sessions import SessionManager
+from archive import Archive
 
 # Must have chromedriver.exe in basepath
 from selenium import webdriver
@@ -24,10 +43,50 @@ import numpy as np
 from info import (GOOGLE_MAPS_KEY, EA_USERNAME,
                   EA_PASSWORD, HOME, WORK)
 
+# lxml builds the detail page tree several times faster when it is installed
+try:
+    import lxml
+    HTML_PARSER = 'lxml'
+except ImportError:
+    HTML_PARSER = 'html.parser'
+
 
 class EALoader(object):
 
-    def __init__(self):
+    def __init__(self, workers=None, login_url=None, maps=None, browser=False, geocache=None, store=None,
+                 refresh=False, refresh_after=6 * 3600, sort=True, sort_chunk=None, metrics=None, limits=None, rules=None, months=3, until=None, sessions=None,
+                 archive=None, radius=100, run=True):
+        # Number of threads used to fetch event pages (None fetches serially)
+        self._workers = workers
+        # Site and Maps traffic recorded into, or served from, an archive.Archive
+        self._archive = archive
+        replaying = bool(archive and archive.replaying)
+        # Discover events through Chrome instead of replaying the calendar postback
+        self._browser = browser and not replaying
+        # Calendar months to discover: `months` from the current one, or every month through the date `until`
+        self._months = discovery.horizon(months, until)
+        # Re-fetch every event (refresh) or only those stored more than refresh_after seconds ago;
+        # an archive always fetches every page, so a recording holds every page its replay asks for
+        self._refresh = refresh or bool(archive)
+        self._refresh_after = refresh_after
+        # Skipped events are remembered this long so their pages are not fetched again; a cancellation
+        # can be undone, so it is only remembered as long as a stored row (refresh_after)
+        self._skip_ttl = 180 * 86400
+        # Why the current thread's last page was skipped
+        self._skipped = threading.local()
+        # Sort the streamed CSV once the run is over, in runs of sort_chunk rows if given
+        self._sort = sort
+        self._sort_chunk = sort_chunk
+        self._sort_by = ['sitename', 'member_status', 'event_status', 'signup_before', 'event_cost', 'event_date']
+        # Set once a run has streamed its rows to the main CSV
+        self._sink_path = None
+        # Read from that CSV at the end of a run, or on first use of dframe when it was sorted in runs
+        self._dframe = None
+        # Events whose page could not be fetched; the change report keeps their previous state
+        self._failed = set()
+        # Stage timings and counters for the run report
+        self._metrics = metrics or Metrics()
+
         # Constant Variables
         self._two_decimals = Decimal('0.01')
         self._special_columns = ['event_status', 'member_status', 'sitename', 'city', 'state', 'event_day', 'dist_from_home', 
@@ -36,13 +95,16 @@ class EALoader(object):
                                 'member_status', 'signup_before', 'cancel_before', 'event_date', 'event_day', 'host', 'event_type',
                                 'duration', 'attire', 'attendees', 'venue_cost', 'event_cost', 'event_tax', 'dist_from_home',
                                 'time_from_home', 'dist_from_work', 'time_from_work', 'street', 'city', 'state', 'zip',
-                                'raw_address', 'sitename', 'url', 
+                                'latitude', 'longitude', 'raw_address', 'sitename', 'url', 
         ]
 
         self._month_dict = {'January': 1, 'February': 2, 'March': 3, 'April': 4, 'May': 5, 'June': 6, 'July': 7,
                             'August': 8, 'September': 9, 'October': 10, 'November': 11, 'December': 12
         }
 
+        # Destinations per distance_matrix call (2 origins x 25 stays under the 100 element cap)
+        self._matrix_chunk = 25
+
         self._weekday_dict = {0: 'Monday', 1: 'Tuesday', 2: 'Wednesday', 3: 'Thursday', 4: 'Friday', 5: 'Saturday', 6: 'Sunday'}
 
         # Regular Expression Patterns
@@ -52,168 +114,331 @@ class EALoader(object):
         self._amt_regex = re.compile(r'[$]?(?P<amt>[\d]*[.]?[\d]*)')
         self._address_regex = re.compile(r'')
 
+        # Detail page schema: field -> (element id, parser), all read in one pass by _scan_event_page
+        text = lambda tag: tag.text.strip()
+        date_text = lambda tag: self._parse_date(tag.text)
+        self._event_fields = {
+            'name_location': ('contentMain_eventnamelocation', self._parse_event),
+            'event_date': ('contentMain_datetime', date_text),
+            'event_status': ('contentMain_eventstatus', lambda tag: tag.text.strip().encode('utf-8')),
+            'member_status': ('contentMain_signupstatus', text),
+            'signup_before': ('contentMain_signupbefore', date_text),
+            'cancel_before': ('contentMain_cancelbefore', date_text),
+            'host': ('contentMain_hosts', lambda tag: tag.text.replace('[Photo]', '').strip()),
+            'event_type': ('contentMain_eventtype', text),
+            'duration': ('contentMain_duration', text),
+            'attire': ('contentMain_attire', text),
+            'attendee_limit': ('contentMain_memberlimit', text),
+            'venue_cost': ('contentMain_venuecost', text),
+            'event_cost': ('contentMain_eventcost', text),
+            'event_tax': ('contentMain_eventtax', text),
+            'address': ('contentMain_venueaddress', text),
+            'sitename': ('contentMain_sitename', text),
+        }
+        self._event_strainer = SoupStrainer(id=[_id for _id, parser in self._event_fields.values()])
+
         # Google Map API
-        self._map = googlemaps.Client(GOOGLE_MAPS_KEY)
+        # Rate limits, adaptive concurrency and retries per destination (site, geocode, distance_matrix)
+        self._limits = limits or (ratelimit.replay_limits if replaying else ratelimit.default_limits)(workers or 1)
+        for destination in self._limits.values():
+            destination.metrics = destination.metrics or self._metrics
+        maps = maps or (None if replaying else googlemaps.Client(GOOGLE_MAPS_KEY))
+        self._map = ratelimit.LimitedMaps(archive.maps(maps) if archive else maps, self._limits)
+        # An archive starts from an empty cache, so every geocode answer a replay needs is recorded
+        self._geocache = geocache or GeocodeCache(':memory:' if archive else os.path.join(os.getcwd(), 'output', 'geocode.sqlite'))
+        # Driving times are only looked up within `radius` straight-line miles of HOME or WORK (None for every venue)
+        self._travel = nearby.TravelData(self._output_fields, self._extract_travel_data,
+                                         lambda address: self._geocache.geocode(self._map, address), HOME, WORK,
+                                         radius, self._matrix_chunk, self._metrics, address='raw_address', code='zip',
+                                         unresolved=lambda address: self._geocache.unresolved(nearby.geocode_text(address)))
+
+        # Parsed events from earlier runs
+        self._store = store or EventStore(os.path.join(os.getcwd(), 'output', 'events.sqlite'))
+        self._store.prune()
+
+        # Calendar entries dropped before their detail page is fetched: the titles _parse_event_page
+        # skips anyway, plus whatever rules.json excludes
+        self._rules = rules or prefilter.Rules.load(os.path.join(os.getcwd(), 'rules.json'), ['new member'])
 
         # Events & Adventures URL
-        self._login_url = 'https://singles.eventsandadventures.com/website/logon.aspx'
+        self._login_url = login_url or 'https://singles.eventsandadventures.com/website/logon.aspx'
+        # One login per run at most, kept in output/ for the runs after it (an archive records its own login)
+        self._sessions = sessions or SessionManager(self._login_url, EA_USERNAME, EA_PASSWORD,
+                                                    None if archive else os.path.join(os.getcwd(), 'output', 'session.json'))
 
-        self._payload = self._parse_payload()
-        
+        if run:
+            self._run()
+
+
+    def _run(self):
         print('\nGathering Event Links...')
         self._events = self._get_event_links()
 
         print('\nParsing Data...')
-        self._data = self._extract_event_details()
-
-        print('\nProducing DataFrame...')
-        self.dframe = self._produce_dataframe()
-
-
-    def _parse_payload(self):
-        res = requests.get(self._login_url)
-        soup = BeautifulSoup(res.content, 'html.parser')
-        form = soup.find('form')
-        payload = dict()
-        for inp in form.find_all('input'):
-            _id = inp.get('id')
-            name = inp.get('name')
-            if 'username' in _id:
-                payload.update({name: EA_USERNAME})
-            elif 'password' in _id:
-                payload.update({name: EA_PASSWORD})
-            else:
-                payload.update({name: inp.get('value')})
-        return payload
+        self._rows = self._stream_events()
+        print('-> Geocode cache: {hits} hits, {negative_hits} known unresolvable, {misses} misses'.format(
+            **self._geocache.stats()))
 
+        if not self._sort_chunk:
+            print('\nProducing DataFrame...')
+            self.dframe = self._produce_dataframe()
+        self.changes = self._write_changes()
 
+
+    @property
+    def dframe(self):
+        if self._dframe is None:
+            self._dframe = self._produce_dataframe()
+        return self._dframe
+
+
+    @dframe.setter
+    def dframe(self, df):
+        self._dframe = df
+
+
+    @timed('discover')
     def _get_event_links(self):
+        if self._browser:
+            return self._get_event_links_browser()
+
+        # Login and switch months through the ASP.NET postback, no browser required
+        with self._mount(requests.Session()) as session:
+            calendar = self._sessions.calendar(session)
+            entries = discovery.discover(session, calendar, self._months)
+        return self._rules.links(entries, self._metrics)
+
+
+    def _get_event_links_browser(self):
         # Login to Events and Adventures
         driver = webdriver.Chrome('./chromedriver')
-        driver.get(self._login_url)
-        username = driver.find_element_by_id('contentMain_username')
-        username.send_keys(EA_USERNAME)
-        password = driver.find_element_by_id('contentMain_password')
-        password.send_keys(EA_PASSWORD)
-        submit = driver.find_element_by_id('contentMain_btnSubmit')
-        submit.click()
+        if not self._sessions.restore(driver):
+            driver.get(self._login_url)
+            username = driver.find_element_by_id('contentMain_username')
+            username.send_keys(EA_USERNAME)
+            password = driver.find_element_by_id('contentMain_password')
+            password.send_keys(EA_PASSWORD)
+            submit = driver.find_element_by_id('contentMain_btnSubmit')
+            submit.click()
+            self._sessions.capture(driver)
         
         # Get to the Calendar
 
         
-        # Parse events for current month
-        event_links = []
-        events = driver.find_elements_by_class_name('calevent')
-        for event in events:
-            event_links.append(event.get_attribute('href'))
-
-
-        # Parse events for next month
-        year, month = self._produce_date(1)
-        select = Select(driver.find_element_by_id('contentMain_lstmonths'))
-        select.select_by_value('{}/1/{}'.format(month, year))
-        events = driver.find_elements_by_class_name('calevent')
-        for event in events:
-            link = event.get_attribute('href')
-            event_links.append(link)
-
-        # Parse events two months out
-        year, month = self._produce_date(2)
-        select = Select(driver.find_element_by_id('contentMain_lstmonths'))
-        select.select_by_value('{}/1/{}'.format(month, year))
-        events = driver.find_elements_by_class_name('calevent')
-        for event in events:
-            link = event.get_attribute('href')
-            event_links.append(link)
+        # Parse events for the current month, then switch to each later one
+        offered = discovery.offered_months(driver.page_source)
+        entries = []
+        for num, (year, month) in enumerate(self._months):
+            if num:
+                if offered and discovery.month_value(year, month) not in offered:
+                    continue
+                select = Select(driver.find_element_by_id(discovery.MONTH_SELECT_ID))
+                select.select_by_value(discovery.month_value(year, month))
+            entries.extend(discovery.page_entries(driver.page_source, driver.current_url, year, month))
 
         driver.close()
-        return event_links
+        return self._rules.links(discovery.unique_entries(entries), self._metrics)
 
 
+    @timed('produce_dataframe')
     def _produce_dataframe(self):
-        df = pd.DataFrame(self._data, columns=self._output_fields)
+        # Read back from the streamed CSV, so the rows are never held in memory next to the frame;
+        # a sorted CSV is already in the frame's order
+        df = pd.read_csv(self._sink_path, dtype=object, parse_dates=columnar.DATE_COLUMNS)
+        columnar.numeric(df, ['dist_from_home', 'time_from_home', 'dist_from_work', 'time_from_work'])
+        return df if self._sort else df.sort_values(by=self._sort_by)
 
-        df.loc[df.member_status.str.strip().str.lower() == 'you are signed up', 'attending'] = 'X'
-        df = df.sort_values(by=['sitename', 'member_status', 'event_status', 'signup_before', 'event_cost', 'event_date'],
-                            ascending=[True, True, True, True, True, True])
 
-        return df
+    @timed('events')
+    def _stream_events(self):
+        # discover -> fetch -> parse run lazily; each distance_matrix batch is enriched,
+        # stored and appended to the main CSV before the next pages are fetched
+        base = os.path.join(os.getcwd(), 'output')
+        if not os.path.exists(base):
+            os.mkdir(base)
+        sink = pipeline.CsvSink(os.path.join(base, 'events_and_adventures.csv'), self._output_fields)
+        # Only the tracked fields of each row are kept, for the change report
+        self._snapshot = changes.Snapshot.for_columns(self._output_fields)
+        try:
+            for batch in pipeline.batched(self._iter_event_details(), self._matrix_chunk):
+                batch = self._mark_attending(self._add_travel_data(batch))
+                self._save_events(batch)
+                sink.write(batch)
+                self._snapshot.add(batch, self._output_fields)
+        finally:
+            sink.close()
+
+        if self._sort:
+            pipeline.sort_csv(sink.path, self._sort_by, chunk_rows=self._sort_chunk)
+        self._sink_path = sink.path
+        return sink.rows
+
+
+    def _mark_attending(self, data):
+        field = self._output_fields.index
+        rows = [list(items) for items in data]
+        for row in rows:
+            if row[field('member_status')].strip().lower() == 'you are signed up':
+                row[field('attending')] = 'X'
+        return [tuple(row) for row in rows]
 
 
     def _extract_event_details(self):
-        data = list()
+        return list(self._iter_event_details())
+
+
+    def _iter_event_details(self):
         with requests.Session() as session:
-            post = session.post(self._login_url, data=self._payload)
-            for link in self._events:
-                request = session.get(link)
-                soup = BeautifulSoup(request.content, 'html.parser')
+            if self._workers:
+                # One connection per worker so the pool never blocks on the adapter
+                self._mount(session, pool_connections=1, pool_maxsize=self._workers)
+            else:
+                self._mount(session)
+            self._sessions.session(session)
+
+            extract = lambda link: self._extract_event(session, link)
+            if self._workers:
+                pool = ThreadPool(self._workers)
+                try:
+                    # Results come back in the order of self._events, a couple of pages ahead at most
+                    for items in pipeline.ordered(pool, extract, self._events, 2 * self._workers):
+                        if items:
+                            yield items
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                for items in imap(extract, self._events):
+                    if items:
+                        yield items
 
-                event_name, event_location = self._parse_event(soup.find(id='contentMain_eventnamelocation'))
-                if 'New Member' in event_name:
-                    continue
 
-                event_date = self._parse_date(soup.find(id='contentMain_datetime').text)
-                if event_date < datetime.now():
-                    # print('-> {:>9}: {}'.format('Passed', event_name))
-                    continue
+    @timed('fetch_event', key=1)
+    def _extract_event(self, session, link):
+        stored = None if self._refresh else self._store.get(link, len(self._output_fields))
+        if stored and (stored.row is None or time.time() - stored.fetched < self._refresh_after):
+            self._metrics.count('event_store', result='reused')
+            return self._stored_event(stored.row)
 
-                event_status = soup.find(id='contentMain_eventstatus').text.strip().encode('utf-8')
-                if event_status.lower() == 'event has passed':
-                    # print('-> {:>9}: {}'.format('Passed', event_name))
-                    continue
+        try:
+            request = self._limits['site'].call(self._sessions.get, session, link)
+        except ratelimit.GaveUp as error:
+            print('-> {:>9}: {}'.format('Failed', error))
+            self._failed.add(link)
+            return self._skip('fetch_failed')
+        self._metrics.count('bytes_fetched', len(request.content))
+        digest = content_hash(request.content)
+        if stored and stored.content_hash == digest:
+            self._metrics.count('event_store', result='unchanged')
+            self._store.touch(link)
+            return self._stored_event(stored.row)
+
+        self._metrics.count('event_store', result='parsed')
+
+        self._skipped.reason = None
+        items = self._parse_event_page(request.content, link)
+        if items is None:
+            ttl = self._refresh_after if self._skipped.reason in VOLATILE_SKIPS else self._skip_ttl
+            self._store.put(link, None, digest, expires=time.time() + ttl)
+        else:
+            self._store.put(link, items, digest, expires=items[self._output_fields.index('event_date')])
+        return items
+
+
+    @timed('parse_event')
+    def _parse_event_page(self, content, link):
+        field = self._scan_event_page(content)
+
+        event_name, event_location = field('name_location')
+        if 'New Member' in event_name:
+            return self._skip('new_member')
+
+        event_date = field('event_date')
+        if event_date < datetime.now():
+            # print('-> {:>9}: {}'.format('Passed', event_name))
+            return self._skip('passed')
+
+        event_status = field('event_status')
+        if event_status.lower() == 'event has passed':
+            # print('-> {:>9}: {}'.format('Passed', event_name))
+            return self._skip('passed')
+
+        member_status = field('member_status')
+        if member_status.lower() == 'you canceled':
+            # print('-> {:>9}: {}'.format('Cancelled', event_name))
+            return self._skip('cancelled')
+
+        signup_before = field('signup_before')
+        if signup_before < datetime.now():
+            # print('-> {:>9}: {}'.format('Closed', event_name))
+            return self._skip('closed')
+
+        if 'full' in event_status.lower():
+            print '-> {:>9}: {}'.format('Full', event_name)
+        elif member_status.lower().strip() == 'you are signed up':
+            print '-> {:>9}: {}'.format('Signed Up', event_name)
+        else:
+            print('-> {:>9}: {}'.format('Available', event_name))
+
+        event_day = self._weekday_dict.get(event_date.weekday(), None)
+        cancel_before = field('cancel_before')
+        host = field('host')
+        event_type = field('event_type')
+        duration = field('duration')
+        attire = field('attire')
+
+        # Get current number of people signed up
+        attendees = None # Found on Sign Up Page
+        attendee_limit = field('attendee_limit')
+        spots_left = None # attendees - attendee_limit (if limited) else None
+
+        # Verify cost on Signup Page
+        venue_cost = field('venue_cost')
+        event_cost = field('event_cost')
+        event_tax = field('event_tax')
+        
+        address = field('address')
 
-                member_status = soup.find(id='contentMain_signupstatus').text.strip()
-                if member_status.lower() == 'you canceled':
-                    # print('-> {:>9}: {}'.format('Cancelled', event_name))
-                    continue
+        # Distances are looked up for all events at once in _add_travel_data
+        dist_from_home, time_from_home, dist_from_work, time_from_work = None, None, None, None
 
-                signup_before = self._parse_date(soup.find(id='contentMain_signupbefore').text)
-                if signup_before < datetime.now():
-                    # print('-> {:>9}: {}'.format('Closed', event_name))
-                    continue
+        street, city, state, code, latitude, longitude = self._parse_address(address)
+        if street or city or state:
+            address = None
+        
+        sitename = field('sitename')
+        
+        return (None, None, None, None, event_name, event_location, event_status, member_status, signup_before,
+                cancel_before, event_date, event_day, host, event_type, duration, attire, attendees, venue_cost,
+                event_cost, event_tax, dist_from_home, time_from_home, dist_from_work, time_from_work, street,
+                city, state, code, latitude, longitude, address, sitename, link)
+
+
+    def _scan_event_page(self, content):
+        # The strainer keeps only the schema's contentMain_* nodes, so the tree is built and walked once
+        soup = BeautifulSoup(content, HTML_PARSER, parse_only=self._event_strainer)
+        tags = dict((tag.get('id'), tag) for tag in soup.find_all(id=True))
 
-                if 'full' in event_status.lower():
-                    print '-> {:>9}: {}'.format('Full', event_name)
-                elif member_status.lower().strip() == 'you are signed up':
-                    print '-> {:>9}: {}'.format('Signed Up', event_name)
-                else:
-                    print('-> {:>9}: {}'.format('Available', event_name))
-
-                event_day = self._weekday_dict.get(event_date.weekday(), None)
-                cancel_before = self._parse_date(soup.find(id='contentMain_cancelbefore').text)
-                host = soup.find(id='contentMain_hosts').text.replace('[Photo]', '').strip()
-                event_type = soup.find(id='contentMain_eventtype').text.strip()
-                duration = soup.find(id='contentMain_duration').text.strip()
-                attire = soup.find(id='contentMain_attire').text.strip()
-
-                # Get current number of people signed up
-                attendees = None # Found on Sign Up Page
-                attendee_limit = soup.find(id='contentMain_memberlimit').text.strip()
-                spots_left = None # attendees - attendee_limit (if limited) else None
-
-                # Verify cost on Signup Page
-                venue_cost = soup.find(id='contentMain_venuecost').text.strip()
-                event_cost = soup.find(id='contentMain_eventcost').text.strip()
-                event_tax = soup.find(id='contentMain_eventtax').text.strip()
-                
-                address = soup.find(id='contentMain_venueaddress').text.strip()
-
-                # Use Google Maps API to determine distance
-                dist_from_home, time_from_home = self._extract_travel_data(HOME, address)
-                dist_from_work, time_from_work = self._extract_travel_data(WORK, address)
-
-                street, city, state, code = self._parse_address(address)
-                if street or city or state:
-                    address = None
-                
-                sitename = soup.find(id='contentMain_sitename').text.strip()
-                
-                items = (None, None, None, None, event_name, event_location, event_status, member_status, signup_before,
-                         cancel_before, event_date, event_day, host, event_type, duration, attire, attendees, venue_cost,
-                         event_cost, event_tax, dist_from_home, time_from_home, dist_from_work, time_from_work, street,
-                         city, state, code, address, sitename, link)
-                data.append(items)
-        return data
+        def field(name):
+            _id, parser = self._event_fields[name]
+            return parser(tags.get(_id))
+        return field
+
+
+    def _stored_event(self, items):
+        reason = stale_reason(items, self._output_fields)
+        return self._skip(reason) if reason else items
+
+
+    def _skip(self, reason):
+        self._skipped.reason = reason
+        self._metrics.count('skipped', reason=reason)
+        return None
+
+
+    def _save_events(self, data):
+        # Keep the travel data so the next run does not look it up again
+        self._store.update_rows(data, self._output_fields.index('url'))
 
 
     ########################
@@ -236,14 +461,21 @@ class EALoader(object):
         return name.strip(), location.strip()
 
 
+    @timed('geocode')
     def _parse_address(self, addr):
-        if "We don't publish member addresses. Address emailed to those signed up" in addr:
-            addr = addr.replace("We don't publish member addresses. Address emailed to those signed up", '')
-        res = self._map.geocode(addr)
+        addr = nearby.geocode_text(addr)
+        try:
+            res = self._geocache.geocode(self._map, addr)
+        except ratelimit.GaveUp as error:
+            # Not cached, so the address is looked up again next run
+            print('-> Geocoding failed: {}'.format(error))
+            self._metrics.count('maps_failed', destination='geocode')
+            return None, None, None, None, None, None
         if len(res):
+            lat, lng = nearby.coordinates(res)
             res = res[0].get('formatted_address', None)
             if res is None:
-                return None, None, None, None
+                return None, None, None, None, lat, lng
 
             res = [i.strip() for i in res.split(',')]
             street = res[0]
@@ -257,19 +489,28 @@ class EALoader(object):
             if street[-len(city):] == city.lower():
                 street = street.replace(city.lower(), '')
 
-            return street, city, state, zcode
+            return street, city, state, zcode, lat, lng
         else:
-            return None, None, None, None
+            return None, None, None, None, None, None
+
 
+    @timed('distance_matrix')
+    def _extract_travel_data(self, origins, destinations):
+        """Return {(origin, destination): (miles, minutes)} from a single distance_matrix call."""
+        res = self._map.distance_matrix(origins, destinations)
+        travel = dict()
+        for origin, row in zip(origins, res.get('rows') or []):
+            for destination, element in zip(destinations, row.get('elements') or []):
+                travel[(origin, destination)] = self._parse_travel_element(element)
+        return travel
 
-    def _extract_travel_data(self, addr1, addr2):
-        res = self._map.distance_matrix(addr1, addr2)
+
+    def _parse_travel_element(self, res):
         try:
-            status = res.get('rows')[0].get('elements')[0].get('status')
+            status = res.get('status')
             if status.lower() == 'not_found':
                 return None, None
 
-            res = res.get('rows')[0].get('elements')[0]
             miles = self._convert_km_to_miles(res.get('distance').get('text').replace(',', ''))
             time = res.get('duration').get('text')
             minutes = 0
@@ -286,21 +527,16 @@ class EALoader(object):
             return miles, minutes
         except TypeError:
             return None, None
+        except AttributeError:
+            return None, None
 
 
     ########################
     #### Helper Methods ####
     ########################
 
-    def _produce_date(self, num):
-        today = date.today()
-        year, month = today.year, today.month
-
-        month += num
-        if month > 12:
-            month %= 12
-            year += 1
-        return year, month
+    def _add_travel_data(self, data):
+        return self._travel.add(data)
 
 
     def _convert_km_to_miles(self, km):
@@ -310,63 +546,15 @@ class EALoader(object):
 
 
     def _add_numeric_travel_data(self, df):
-        dist_regex = re.compile(r'(?P<amount>[\d,]*[.]?[\d]*) miles')
-        time_regex = re.compile(r'(?P<amount>[\d,]*[.]?[\d]*) minutes')
-
-        df['dist_from_home_num'] = df.dist_from_home\
-                                   .str.extract(pat=dist_regex, expand=False)\
-                                   .str.replace(',', '').astype(float, na=False)
-        df['time_from_home_num'] = df.time_from_home\
-                                   .str.extract(pat=time_regex, expand=False)\
-                                   .str.replace(',', '').astype(float, na=False)
-        
-        df['dist_from_work_num'] = df.dist_from_work\
-                                   .str.extract(pat=dist_regex, expand=False)\
-                                   .str.replace(',', '').astype(float, na=False)
-        df['time_from_work_num'] = df.time_from_work\
-                                   .str.extract(pat=time_regex, expand=False)\
-                                   .str.replace(',', '').astype(float, na=False)
-
+        for col in ('dist_from_home', 'time_from_home', 'dist_from_work', 'time_from_work'):
+            df['{}_num'.format(col)] = df[col].astype(float)
         return df
 
-    def _range_writer(self, df, col, directory):
-        nums = [10, 15, 20, 25, 30, 40, 50, 60, 100]
-        DF = df.copy()
-        file_col = col.replace('_', ' ')
-        col_num = '{}_num'.format(col)
-        for idx, num in enumerate(nums):
-            outputs = []
-            if idx == 0:
-                filename = '{} less than {}.csv'.format(file_col, num)
-                df = DF.loc[DF[col_num] < num]
-                if df.shape[0]:
-                    outputs.append([filename, df])
-            elif idx == len(nums) - 1:
-                filename = '{} greater than {}.csv'.format(file_col, num)
-                df = DF.loc[DF[col_num] > num]
-                if df.shape[0]:
-                    outputs.append([filename, df])
-                n1, n2 = nums[idx-1], nums[idx]
-                filename = '{} between {} and {}.csv'.format(file_col, n1, n2)
-                df = DF.loc[(DF[col_num] > n1) & (DF[col_num] < n2)]
-                if df.shape[0]:
-                    outputs.append([filename, df]) 
-            else:
-                n1, n2 = nums[idx-1], nums[idx]
-                filename = '{} between {} and {}.csv'.format(file_col, n1, n2)
-                df = DF.loc[(DF[col_num] > n1) & (DF[col_num] < n2)]
-                if df.shape[0]:
-                    outputs.append([filename, df]) 
-
-            for filename, df in outputs:
-                filepath = os.path.join(directory, filename)
-                df.iloc[:, 4:-4].to_csv(filepath, encoding='utf-8', index=False)
-
-
     ######################
     #### MISC Methods ####
     ######################
 
+    @timed('write_files')
     def write_files(self, all=False):
         print('\nWriting Files...')
         filename = 'events_and_adventures.csv'
@@ -374,34 +562,87 @@ class EALoader(object):
         if not os.path.exists(base):
             os.mkdir(base)
         filepath = os.path.join(base, filename)
-        self.dframe.to_csv(filepath, encoding='utf-8', index=False)
+        # A streamed run has already written (and sorted) the main file
+        if self._sink_path != filepath:
+            self.dframe.to_csv(filepath, encoding='utf-8', index=False)
 
         if all:
             df = self._add_numeric_travel_data(self.dframe.copy())
-            for col in self._special_columns:
-                print('-> {}'.format(col))
-                directory = os.path.join(base, col)
-                if os.path.exists(directory):
-                    rmtree(directory)
-                os.mkdir(directory)
+            write_partitions(df, base, self._special_columns, numeric='{}_num'.format,
+                             output=lambda frame: frame.iloc[:, 4:-4])
+        else:
+            # Partitions of an earlier run would still hold marks EAUpdater reads
+            clear_partitions(base, self._special_columns)
+
+
+    @timed('changes')
+    def _write_changes(self):
+        # output/changes.csv holds what changed since the previous run, output/snapshot.json what it is compared to
+        return changes.report(self._snapshot, os.path.join(os.getcwd(), 'output'), self._failed)
+
 
-                for item in df[col].dropna().drop_duplicates():
-                    if '_from_' in col:
-                        self._range_writer(df, col, directory)
-                    else:
-                        filepath = os.path.join(directory, '{}.csv'.format(item))
-                        df.iloc[:, 4:-4].loc[df[col] == item].to_csv(filepath, encoding='utf-8', index=False)
+    def write_report(self, textfile=None):
+        self._metrics.write_report(os.path.join(os.getcwd(), 'output'), textfile,
+                                   geocode_cache=self._geocache.stats(), html_parser=HTML_PARSER)
 
 
     def _get_soup(self, url):
-        with requests.Session() as session:
-            post = session.post(self._login_url, data=self._payload)
-            return BeautifulSoup(session.get(url).content, 'html.parser')
+        with self._sessions.session(self._mount(requests.Session())) as session:
+            return BeautifulSoup(self._sessions.get(session, url).content, 'html.parser')
+
+
+    def _mount(self, session, **kwargs):
+        # Record or replay the site through the archive when there is one
+        if self._archive:
+            return self._archive.mount(session, **kwargs)
+        if kwargs:
+            adapter = requests.adapters.HTTPAdapter(**kwargs)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+        return session
 
 
 def main():
-    ea = EALoader()
-    ea.write_files(all=True)
+    parser = argparse.ArgumentParser(description='Load upcoming Events & Adventures events into output/')
+    parser.add_argument('--refresh', action='store_true', help='re-fetch every event instead of reusing the event store')
+    parser.add_argument('--workers', type=int, default=8, help='threads fetching event detail pages (0 fetches them one at a time)')
+    parser.add_argument('--partitions', action='store_true',
+                        help='also write one CSV per site, city, state, weekday, status and distance band (see query.py)')
+    archiving = parser.add_mutually_exclusive_group()
+    archiving.add_argument('--record', metavar='ZIP', default=None, help='save every site page and Maps answer into this archive')
+    archiving.add_argument('--replay', metavar='ZIP', default=None, help='load from a recorded archive without touching the network')
+    parser.add_argument('--months', type=int, default=3, help='calendar months to load, starting with the current one')
+    parser.add_argument('--until', type=lambda text: datetime.strptime(text, '%Y-%m-%d').date(), default=None,
+                        help='load every calendar month through this date (YYYY-MM-DD) instead of --months')
+    parser.add_argument('--radius', type=float, default=100,
+                        help='only look up driving times for venues within this many straight-line miles of HOME or WORK')
+    parser.add_argument('--any-distance', dest='radius', action='store_const', const=None,
+                        help='look up driving times for every venue')
+    parser.add_argument('--sort-chunk', type=int, default=None,
+                        help='sort the output CSV in runs of this many rows instead of in memory')
+    parser.add_argument('--metrics-textfile', default=None, help='also write the run metrics to this Prometheus textfile')
+    parser.add_argument('--profile', nargs='?', const='sample', choices=['sample', 'cprofile'], default=None,
+                        help='profile the run into output/profile (sampling, or cprofile for a deterministic profile too)')
+    args = parser.parse_args()
+    archive = Archive(args.record, 'record') if args.record else Archive(args.replay) if args.replay else None
+
+    def run():
+        ea = EALoader(workers=args.workers, refresh=args.refresh, sort_chunk=args.sort_chunk, months=args.months, until=args.until,
+                      archive=archive, radius=args.radius)
+        ea.write_files(all=args.partitions)
+        return ea
+
+    try:
+        if args.profile:
+            directory = os.path.join(os.getcwd(), 'output', 'profile')
+            ea = profiling.profile(run, directory, args.profile)
+            profiling.write_event_times(ea._metrics.by_key('fetch_event'), os.path.join(directory, 'event_times.csv'))
+        else:
+            ea = run()
+    finally:
+        if archive:
+            archive.close()
+    ea.write_report(args.metrics_textfile)
 
 
 if __name__ == '__main__':
@@ -1,14 +1,33 @@
 
-import os, sys, re
+import os, sys, re, time
+import threading
+import argparse
 from glob import glob
-from datetime import date, datetime
-from shutil import rmtree
+from datetime import datetime
+from collections import namedtuple
 from cdecimal import Decimal
 import googlemaps
 
 import requests
 from bs4 import BeautifulSoup
 
+import discovery
+from geocache import GeocodeCache
+import nearby
+from store import EventStore, VOLATILE_SKIPS, content_hash, stale_reason
+from partition import write_partitions, clear_partitions
+import columnar
+import changes
+from query import EventIndex
+import pipeline
+from metrics import Metrics, timed
+import profiling
+import ratelimit
+import prefilter
+import browsers
+from sessions import SessionManager
+from archive import Archive
+
 # Must have chromedriver.exe in basepath
 from selenium import webdriver
 from selenium.webdriver.support.ui import Select
@@ -25,22 +44,78 @@ from info import (GOOGLE_MAPS_KEY, EA_USERNAME,
                   EA_PASSWORD, HOME, WORK)
 
 
-def login():
+LOGIN_URL = 'https://singles.eventsandadventures.com/website/logon.aspx'
+
+# One pending sign-up, wait-list or cancel request for EAUpdater
+Action = namedtuple('Action', ['kind', 'url', 'name'])
+
+
+def login(headless=True, sessions=None):
     # Login to Events and Adventures
-    login_url = 'https://singles.eventsandadventures.com/website/logon.aspx'
-    driver = webdriver.Chrome('./chromedriver')
-    driver.get(login_url)
+    driver = webdriver.Chrome('./chromedriver', chrome_options=browsers.chrome_options(headless))
+    sign_in(driver, sessions)
+    return driver
+
+
+def sign_in(driver, sessions=None):
+    # Reuse the stored login when there is one, else post the form and store it
+    if sessions and sessions.restore(driver):
+        return
+    driver.get(LOGIN_URL)
     driver.find_element_by_id('contentMain_username').send_keys(EA_USERNAME)
     driver.find_element_by_id('contentMain_password').send_keys(EA_PASSWORD)
     driver.find_element_by_id('contentMain_btnSubmit').click()
-    return driver
+    if sessions:
+        sessions.capture(driver)
+
+
+def session_manager(keep=True):
+    # keep=False logs in afresh and stores nothing, e.g. when the login is being recorded
+    path = os.path.join(os.getcwd(), 'output', 'session.json') if keep else None
+    return SessionManager(LOGIN_URL, EA_USERNAME, EA_PASSWORD, path)
 
 
 class EALoader(object):
 
-    def __init__(self):
+    def __init__(self, workers=4, browser=False, refresh=False, refresh_after=6 * 3600, maps=None, geocache=None, store=None,
+                 sort=True, sort_chunk=None, metrics=None, limits=None, rules=None, months=3, until=None, sessions=None,
+                 archive=None, radius=100, run=True):
+        # Logged-in headless browsers the event pages are spread across
+        self._workers = workers
+        # Site and Maps traffic recorded into, or served from, an archive.Archive
+        self._archive = archive
+        replaying = bool(archive and archive.replaying)
+        # Switch calendar months in Chrome instead of replaying the ASP.NET postback
+        self._browser = browser and not replaying
+        # Calendar months to discover: `months` from the current one, or every month through the date `until`
+        self._months = discovery.horizon(months, until)
+        # Re-fetch every event (refresh) or only those stored more than refresh_after seconds ago;
+        # an archive always fetches every page, so a recording holds every page its replay asks for
+        self._refresh = refresh or bool(archive)
+        self._refresh_after = refresh_after
+        # Skipped events are remembered this long so their pages are not opened again; a cancellation
+        # can be undone, so it is only remembered as long as a stored row (refresh_after)
+        self.__skip_ttl = 180 * 86400
+        # Why the current thread's last page was skipped
+        self._skipped = threading.local()
+        # Sort the streamed CSV once the run is over, in runs of sort_chunk rows if given
+        self._sort = sort
+        self._sort_chunk = sort_chunk
+        self.__sort_by = ['sitename', 'event_status', 'member_status', 'spots_left', 'attendees', 'event_date', 'event_cost']
+        self.__sort_ascending = [True, True, True, True, False, True, True]
+        # Set once a run has streamed its rows to the main CSV
+        self._sink_path = None
+        # Read from that CSV at the end of a run, or on first use of df when it was sorted in runs
+        self._df = None
+        # Events whose page could not be fetched; the change report keeps their previous state
+        self._failed = set()
+        # Stage timings and counters for the run report
+        self._metrics = metrics or Metrics()
+
         # Constant Variables
         self.__two_decimals = Decimal('0.01')
+        # Destinations per distance_matrix call (2 origins x 25 stays under the 100 element cap)
+        self.__matrix_chunk = 25
         self.__special_columns = ['event_status', 'member_status', 'sitename', 'city', 'state', 'event_day', 'dist_from_home', 
                                  'dist_from_work', 'time_from_work', 'time_from_home',]
 
@@ -48,46 +123,127 @@ class EALoader(object):
                                'event_location', 'event_day', 'event_date', 'signup_before', 'cancel_before', 'event_cost',
                                'event_tax', 'venue_cost', 'spots_left', 'attendees', 'limit', 'duration', 'dist_from_home',
                                'time_from_home', 'dist_from_work', 'time_from_work', 'street', 'city', 'state', 'code',
-                               'phone', 'address', 'host', 'attire', 'sitename', 'url',]
+                               'latitude', 'longitude', 'phone', 'address', 'host', 'attire', 'sitename', 'url',]
+
+        # One login shared by the requests session and every browser, kept in output/ between runs
+        self._sessions = sessions or session_manager(keep=archive is None)
+
+        # Calendar entries dropped before their detail page is opened: the titles _parse_event_data
+        # skips anyway, plus whatever rules.json excludes
+        self._rules = rules or prefilter.Rules.load(os.path.join(os.getcwd(), 'rules.json'),
+                                                    ['new member', 'host meeting'])
 
         # Google Map API
-        self._map = googlemaps.Client(GOOGLE_MAPS_KEY)
-        
+        # Rate limits, adaptive concurrency and retries per destination (site, geocode, distance_matrix)
+        self._limits = limits or (ratelimit.replay_limits if replaying else ratelimit.default_limits)(workers)
+        for destination in self._limits.values():
+            destination.metrics = destination.metrics or self._metrics
+        maps = maps or (None if replaying else googlemaps.Client(GOOGLE_MAPS_KEY))
+        self._map = ratelimit.LimitedMaps(archive.maps(maps) if archive else maps, self._limits)
+        # An archive starts from an empty cache, so every geocode answer a replay needs is recorded
+        self._geocache = geocache or GeocodeCache(':memory:' if archive else os.path.join(os.getcwd(), 'output', 'geocode.sqlite'))
+        # Driving times are only looked up within `radius` straight-line miles of HOME or WORK (None for every venue)
+        self._travel = nearby.TravelData(self._output_fields, self._extract_travel_data,
+                                         lambda address: self._geocache.geocode(self._map, address), HOME, WORK,
+                                         radius, self.__matrix_chunk, self._metrics, address='address', code='code',
+                                         unresolved=lambda address: self._geocache.unresolved(nearby.geocode_text(address)))
+
+        # Parsed events from earlier runs
+        self._store = store or EventStore(os.path.join(os.getcwd(), 'output', 'events.sqlite'))
+        self._store.prune()
+
+        if run:
+            self._run()
+
+
+    def _run(self):
         print('\nGathering Event Data...')
-        self._data = self._get_event_data()
+        self._rows = self._stream_events()
+        print('-> Geocode cache: {hits} hits, {negative_hits} known unresolvable, {misses} misses'.format(
+            **self._geocache.stats()))
 
-        print('\nProducing DataFrame...')
-        self.df = self._produce_dataframe()
+        if not self._sort_chunk:
+            print('\nProducing DataFrame...')
+            self.df = self._produce_dataframe()
+        self.changes = self._write_changes()
 
         self.write_files()
 
 
-    def _get_event_links(self, driver):
-        return [i.get_attribute('href') for i in driver.find_elements_by_class_name('calevent')]
+    @property
+    def df(self):
+        if self._df is None:
+            self._df = self._produce_dataframe()
+        return self._df
+
+
+    @df.setter
+    def df(self, df):
+        self._df = df
+
+
+    def _get_event_entries(self, driver, year, month):
+        return discovery.page_entries(driver.page_source, driver.current_url, year, month)
 
 
+    @timed('fetch_event', key=1)
     def _extract_event_data(self, driver, link):
-        driver.get(link)
+        stored = None if self._refresh else self._store.get(link, len(self._output_fields))
+        if stored and (stored.row is None or time.time() - stored.fetched < self._refresh_after):
+            self._metrics.count('event_store', result='reused')
+            return self._stored_event(stored.row)
+
+        try:
+            self._limits['site'].call(driver.get, link)
+            if self._sessions.lapsed(driver.current_url, driver.page_source):
+                sign_in(driver, self._sessions)
+                self._limits['site'].call(driver.get, link)
+        except ratelimit.GaveUp as error:
+            print('-> {:>9}: {}'.format('Failed', error))
+            self._failed.add(link)
+            return self._skip('fetch_failed')
+        source = driver.page_source
+        self._metrics.count('bytes_fetched', len(source.encode('utf-8')))
+        digest = content_hash(source)
+        if stored and stored.content_hash == digest:
+            self._metrics.count('event_store', result='unchanged')
+            self._store.touch(link)
+            return self._stored_event(stored.row)
+
+        self._metrics.count('event_store', result='parsed')
+
+        self._skipped.reason = None
+        item = self._parse_event_data(driver, link)
+        if item is None:
+            ttl = self._refresh_after if self._skipped.reason in VOLATILE_SKIPS else self.__skip_ttl
+            self._store.put(link, None, digest, expires=time.time() + ttl)
+        else:
+            self._store.put(link, item, digest, expires=item[self._output_fields.index('event_date')])
+        return item
+
+
+    @timed('parse_event')
+    def _parse_event_data(self, driver, link):
         find = driver.find_element_by_id
 
         attending, sign_up, wait_list, cancel = None, None, None, None
 
         event_name, event_location = find('contentMain_eventnamelocation').text.encode('utf-8').split('\n')
         if 'new member' in event_name.lower() or 'host meeting' in event_name.lower():
-            return None
+            return self._skip('new_member')
 
         if 'no event' in event_location.lower():
-            return None
+            return self._skip('no_event')
 
         event_day, event_date = self._parse_date(find('contentMain_datetime').text.strip())
         if event_date < datetime.now():
             # print('-> {:>9}: {}'.format('Passed', event_name))
-            return None
+            return self._skip('passed')
 
         event_status = find('contentMain_eventstatus').text.encode('utf-8').strip().lower()
         if event_status == 'event has passed':
             # print('-> {:>9}: {}'.format('Passed', event_name))
-            return None
+            return self._skip('passed')
         elif 'full' in event_status:
             event_status = 'full'
         elif 'available' in event_status:
@@ -96,7 +252,7 @@ class EALoader(object):
         member_status = find('contentMain_signupstatus').text.encode('utf-8').strip().lower()
         if 'cancel' in member_status:
             # print('-> {:>9}: {}'.format('Cancelled', event_name))
-            return None
+            return self._skip('cancelled')
         elif 'you are' in member_status:
             member_status = 'signed up'
             attending = 'x'
@@ -104,7 +260,7 @@ class EALoader(object):
         _, signup_before = self._parse_date(find('contentMain_signupbefore').text.strip())
         if signup_before < datetime.now():
             # print('-> {:>9}: {}'.format('Closed', event_name))
-            return None
+            return self._skip('closed')
 
         if 'full' in event_status:
             print '-> {:>9}: {}'.format('Full', event_name)
@@ -125,9 +281,9 @@ class EALoader(object):
         event_cost = self._determine_cost(event_name, find('contentMain_eventdescription').text.encode('utf-8').strip(), event_cost)
 
         address = find('contentMain_venueaddress').text.encode('utf-8').replace('\n', ' ').strip()
-        dist_from_home, time_from_home = self._extract_travel_data(HOME, address)
-        dist_from_work, time_from_work = self._extract_travel_data(WORK, address)
-        street, city, state, code = self._parse_address(address)
+        # Distances are looked up for all events at once in _add_travel_data
+        dist_from_home, time_from_home, dist_from_work, time_from_work = None, None, None, None
+        street, city, state, code, latitude, longitude = self._parse_address(address)
         phone = self._parse_phone(address)
         if street or city or state:
             address = None
@@ -144,52 +300,114 @@ class EALoader(object):
             attending, sign_up, wait_list, cancel, event_status, member_status, event_name, event_location,
             event_day, event_date, signup_before, cancel_before, event_cost, event_tax, venue_cost, spots,
             attendees, limit, duration, dist_from_home, time_from_home, dist_from_work, time_from_work,
-            street, city, state, code, phone, address, host, attire, sitename, link, 
+            street, city, state, code, latitude, longitude, phone, address, host, attire, sitename, link, 
         )
 
 
-    def _get_event_data(self):
-        driver = login()
+    @timed('events')
+    def _stream_events(self):
+        # Events are enriched, stored and appended to the main CSV one distance_matrix batch at a time
+        base = os.path.join(os.getcwd(), 'output')
+        if not os.path.exists(base):
+            os.mkdir(base)
+        sink = pipeline.CsvSink(os.path.join(base, 'events_and_adventures.csv'), self._output_fields)
+        # Only the tracked fields of each row are kept, for the change report
+        self._snapshot = changes.Snapshot.for_columns(self._output_fields)
+        try:
+            for batch in pipeline.batched(self._iter_event_data(), self.__matrix_chunk):
+                batch = self._add_travel_data(batch)
+                self._save_events(batch)
+                sink.write(batch)
+                self._snapshot.add(batch, self._output_fields)
+        finally:
+            sink.close()
+
+        if self._sort:
+            pipeline.sort_csv(sink.path, self.__sort_by, self.__sort_ascending, chunk_rows=self._sort_chunk)
+        self._sink_path = sink.path
+        return sink.rows
+
+
+    def _iter_event_data(self):
+        if self._browser:
+            entries = None
+        else:
+            # Collect every month's links over plain HTTP before Chrome is started
+            with self._metrics.timer('discover'), self._mount(requests.Session()) as session:
+                calendar = self._sessions.calendar(session)
+                entries = discovery.discover(session, calendar, self._months)
+
+        pool = browsers.BrowserPool(self._start_browser, self._workers, metrics=self._metrics)
+        try:
+            if entries is None:
+                with self._metrics.timer('discover'), pool.driver() as driver:
+                    entries = self._get_calendar_entries(driver)
+            # Titles and days on the calendar already rule out some events
+            event_links = self._rules.links(entries, self._metrics)
+
+            for item in pool.map(self._extract_event_data, event_links):
+                if item:
+                    yield item
+        finally:
+            pool.close()
+
+
+    def _start_browser(self):
+        # Replays read the archived pages without Chrome; recordings keep every page Chrome loads
+        if self._archive and self._archive.replaying:
+            return self._archive.driver()
+        driver = login(sessions=self._sessions)
+        return self._archive.driver(driver) if self._archive else driver
+
+
+    def _mount(self, session, **kwargs):
+        # Record or replay the site through the archive when there is one
+        if self._archive:
+            return self._archive.mount(session, **kwargs)
+        return session
+
+
+    def _get_calendar_entries(self, driver):
         driver.find_element_by_id('PublicNav1_lnkCalendar').click()
         cal_url = driver.current_url
 
-        data = list()
-        
-        # Parse events for current month
-        event_links = []
-        for link in self._get_event_links(driver):
-            item = self._extract_event_data(driver, link)
-            if item:
-                data.append(item)
-
-        # Parse events for next month
-        driver.get(cal_url)
-        year, month = self._produce_date(1)
-        select = Select(driver.find_element_by_id('contentMain_lstmonths'))
-        select.select_by_value('{}/1/{}'.format(month, year))
-        for link in self._get_event_links(driver):
-            item = self._extract_event_data(driver, link)
-            if item:
-                data.append(item)
-
-        # Parse events two months out
-        driver.get(cal_url)
-        year, month = self._produce_date(2)
-        select = Select(driver.find_element_by_id('contentMain_lstmonths'))
-        select.select_by_value('{}/1/{}'.format(month, year))
-        for link in self._get_event_links(driver):
-            item = self._extract_event_data(driver, link)
-            if item:
-                data.append(item)
-
-        driver.close()
-        return data
+        # Parse events for the current month, then switch to each later one from a fresh calendar
+        offered = discovery.offered_months(driver.page_source)
+        entries = []
+        for num, (year, month) in enumerate(self._months):
+            if num:
+                if offered and discovery.month_value(year, month) not in offered:
+                    continue
+                driver.get(cal_url)
+                select = Select(driver.find_element_by_id(discovery.MONTH_SELECT_ID))
+                select.select_by_value(discovery.month_value(year, month))
+            entries.extend(self._get_event_entries(driver, year, month))
+
+        return discovery.unique_entries(entries)
 
 
+    @timed('produce_dataframe')
     def _produce_dataframe(self):
-        df = pd.DataFrame(self._data, columns=self._output_fields)
-        return df.sort_values(by=['sitename', 'event_status', 'member_status', 'spots_left', 'attendees', 'event_date', 'event_cost'],
-                            ascending=[True, True, True, True, False, True, True])
+        # Read back from the streamed CSV, so the rows are never held in memory next to the frame;
+        # the frame holds cents and plain numbers, and a sorted CSV is already in its order
+        df = columnar.compact(pd.read_csv(self._sink_path, dtype=object))
+        return df if self._sort else df.sort_values(by=self.__sort_by, ascending=self.__sort_ascending)
+
+
+    def _stored_event(self, items):
+        reason = stale_reason(items, self._output_fields)
+        return self._skip(reason) if reason else items
+
+
+    def _skip(self, reason):
+        self._skipped.reason = reason
+        self._metrics.count('skipped', reason=reason)
+        return None
+
+
+    def _save_events(self, data):
+        # Keep the travel data so the next run does not look it up again
+        self._store.update_rows(data, self._output_fields.index('url'))
 
 
     ########################
@@ -305,14 +523,21 @@ class EALoader(object):
         return name.strip(), location.strip()
 
 
+    @timed('geocode')
     def _parse_address(self, addr):
-        if "We don't publish member addresses. Address emailed to those signed up" in addr:
-            addr = addr.replace("We don't publish member addresses. Address emailed to those signed up", '')
-        res = self._map.geocode(addr)
+        addr = nearby.geocode_text(addr)
+        try:
+            res = self._geocache.geocode(self._map, addr)
+        except ratelimit.GaveUp as error:
+            # Not cached, so the address is looked up again next run
+            print('-> Geocoding failed: {}'.format(error))
+            self._metrics.count('maps_failed', destination='geocode')
+            return None, None, None, None, None, None
         if len(res):
+            lat, lng = nearby.coordinates(res)
             res = res[0].get('formatted_address', None)
             if res is None:
-                return None, None, None, None
+                return None, None, None, None, lat, lng
 
             res = [i.strip() for i in res.split(',')]
             street = res[0]
@@ -326,19 +551,28 @@ class EALoader(object):
             if street[-len(city):] == city.lower():
                 street = street.replace(city.lower(), '')
 
-            return street, city, state, zcode
+            return street, city, state, zcode, lat, lng
         else:
-            return None, None, None, None
+            return None, None, None, None, None, None
+
+
+    @timed('distance_matrix')
+    def _extract_travel_data(self, origins, destinations):
+        """Return {(origin, destination): (miles, minutes)} from a single distance_matrix call."""
+        res = self._map.distance_matrix(origins, destinations)
+        travel = dict()
+        for origin, row in zip(origins, res.get('rows') or []):
+            for destination, element in zip(destinations, row.get('elements') or []):
+                travel[(origin, destination)] = self._parse_travel_element(element)
+        return travel
 
 
-    def _extract_travel_data(self, addr1, addr2):
-        res = self._map.distance_matrix(addr1, addr2)
+    def _parse_travel_element(self, res):
         try:
-            status = res.get('rows')[0].get('elements')[0].get('status')
+            status = res.get('status')
             if status.lower() == 'not_found':
                 return None, None
 
-            res = res.get('rows')[0].get('elements')[0]
             miles = self._convert_km_to_miles(res.get('distance').get('text').replace(',', ''))
             time = res.get('duration').get('text')
             minutes = 0
@@ -354,25 +588,17 @@ class EALoader(object):
             minutes = Decimal(minutes)
             return miles, minutes
         except TypeError:
-            pass
+            return None, None
         except AttributeError:
-            pass
-        return None, None
+            return None, None
 
 
     ########################
     #### Helper Methods ####
     ########################
 
-    def _produce_date(self, num):
-        today = date.today()
-        year, month = today.year, today.month
-
-        month += num
-        if month > 12:
-            month %= 12
-            year += 1
-        return year, month
+    def _add_travel_data(self, data):
+        return self._travel.add(data)
 
 
     def _convert_km_to_miles(self, km):
@@ -381,43 +607,11 @@ class EALoader(object):
         return (km * Decimal('0.62137')).quantize(self.__two_decimals)
 
 
-    def _range_writer(self, df, col, directory):
-        nums = [10, 15, 20, 25, 30, 40, 50, 60, 100]
-        DF = df.copy()
-        file_col = col.replace('_', ' ')
-        for idx, num in enumerate(nums):
-            outputs = []
-            if idx == 0:
-                filename = '{} less than {}.csv'.format(file_col, num)
-                df = DF.loc[DF[col] < num]
-                if df.shape[0]:
-                    outputs.append([filename, df])
-            elif idx == len(nums) - 1:
-                filename = '{} greater than {}.csv'.format(file_col, num)
-                df = DF.loc[DF[col] > num]
-                if df.shape[0]:
-                    outputs.append([filename, df])
-                n1, n2 = nums[idx-1], nums[idx]
-                filename = '{} between {} and {}.csv'.format(file_col, n1, n2)
-                df = DF.loc[(DF[col] > n1) & (DF[col] < n2)]
-                if df.shape[0]:
-                    outputs.append([filename, df]) 
-            else:
-                n1, n2 = nums[idx-1], nums[idx]
-                filename = '{} between {} and {}.csv'.format(file_col, n1, n2)
-                df = DF.loc[(DF[col] > n1) & (DF[col] < n2)]
-                if df.shape[0]:
-                    outputs.append([filename, df]) 
-
-            for filename, df in outputs:
-                filepath = os.path.join(directory, filename)
-                df.to_csv(filepath, encoding='utf-8', index=False)
-
-
     # ######################
     # #### MISC Methods ####
     # ######################
 
+    @timed('write_files')
     def write_files(self, all=False):
         print('\nWriting File{}...'.format('s' if all else ''))
         filename = 'events_and_adventures.csv'
@@ -425,57 +619,97 @@ class EALoader(object):
         if not os.path.exists(base):
             os.mkdir(base)
         filepath = os.path.join(base, filename)
-        self.df.to_csv(filepath, encoding='utf-8', index=False)
+        # A streamed run has already written (and sorted) the main file
+        if self._sink_path != filepath:
+            columnar.readable(self.df).to_csv(filepath, encoding='utf-8', index=False)
+
+        if not columnar.available():
+            print('pyarrow not installed, skipping events_and_adventures.parquet')
+        elif self._df is None and self._sort_chunk:
+            # Converted sort_chunk rows at a time, so the whole frame is never built for it
+            chunks = pd.read_csv(self._sink_path, dtype=object, chunksize=self._sort_chunk)
+            columnar.write_chunks((columnar.compact(chunk) for chunk in chunks),
+                                  os.path.join(base, 'events_and_adventures.parquet'))
+        else:
+            columnar.write(columnar.compact(self.df), os.path.join(base, 'events_and_adventures.parquet'))
 
         if all:
-            df = self.df.copy()
-            for col in self.__special_columns:
-                print('-> {}'.format(col))
-                directory = os.path.join(base, col)
-                if os.path.exists(directory):
-                    rmtree(directory)
-                os.mkdir(directory)
-
-                for item in df[col].dropna().drop_duplicates():
-                    if '_from_' in col:
-                        self._range_writer(df, col, directory)
-                    else:
-                        filepath = os.path.join(directory, '{}.csv'.format(item.encode('utf-8', errors='replace')))
-                        df.loc[df[col] == item].to_csv(filepath, encoding='utf-8', index=False)
+            write_partitions(columnar.readable(self.df), base, self.__special_columns,
+                             filename=lambda item: item.encode('utf-8', errors='replace'))
+        else:
+            # Partitions of an earlier run would still hold marks EAUpdater reads
+            clear_partitions(base, self.__special_columns)
+
+
+    @timed('changes')
+    def _write_changes(self):
+        # output/changes.csv holds what changed since the previous run, output/snapshot.json what it is compared to
+        return changes.report(self._snapshot, os.path.join(os.getcwd(), 'output'), self._failed)
+
+
+    def write_report(self, textfile=None):
+        self._metrics.write_report(os.path.join(os.getcwd(), 'output'), textfile,
+                                   geocode_cache=self._geocache.stats())
 
 
 class EAUpdater(object):
 
-    def __init__(self):
+    def __init__(self, workers=4, changed=False):
         dfpath = os.path.join(os.getcwd(), 'output', 'events_and_adventures.csv')
         if os.path.exists(dfpath):
-            self.df = pd.read_csv(dfpath)
+            self.df = self._load_events(dfpath)
         else:
             print('\nNo dataframe found at: {}\nRun EALoader() routine before calling EAUpdater()\n'.format(dfpath))
             sys.exit()
-        # self.driver = login()
+        # Row marks left behind once an action has gone through
+        self.__outcome_marks = {
+            'sign_up': {'attending': 'x', 'sign_up': None},
+            'wait_list': {'attending': None, 'wait_list': None},
+            'cancel': {'attending': None, 'cancel': None},
+        }
+        # Sign-up pages are prepared on several browsers; the confirmations are asked one at a time
+        self._workers = workers
+        self._prompt_lock = threading.RLock()
+        # Only the events the last loader run found new or changed (output/changes.csv)
+        self._changed = changes.changed_urls(os.path.join(os.getcwd(), 'output', 'changes.csv')) if changed else None
         self._signup, self._wait, self._cancel = self._get_dataframes()
+        self._queue = self._queue_actions()
+        self._outcomes = []
         self.take_action()
 
 
-    def _get_dataframes(self):
-        files = glob(os.path.join(os.getcwd(), 'output', '*', '*.csv'))
-        df = self.df.copy()
-        for filepath in files:
-            df = df.append(pd.read_csv(filepath))
+    def _load_events(self, dfpath):
+        # The Parquet copy keeps the loader's dtypes; marks typed into the CSV
+        # after it was written are laid back over it by url
+        pqpath = os.path.splitext(dfpath)[0] + '.parquet'
+        if not columnar.available() or not os.path.exists(pqpath):
+            return columnar.compact(pd.read_csv(dfpath))
+        df = columnar.read(pqpath)
+        if os.path.getmtime(dfpath) > os.path.getmtime(pqpath):
+            marks = ['attending', 'sign_up', 'wait_list', 'cancel']
+            edited = pd.read_csv(dfpath, usecols=marks + ['url']).drop_duplicates('url').set_index('url')
+            if set(edited.index) != set(df.url):
+                # CSV was rewritten by another loader run
+                return columnar.compact(pd.read_csv(dfpath))
+            df[marks] = edited.reindex(df.url)[marks].values
+        return df
 
-        signup_not_null = ~df.sign_up.isnull()
-        attending_is_null = df.attending.isnull()
-        attending_not_null = ~df.attending.isnull()
-        event_is_full = df.event_status.str.contains('full')
-        event_not_full = ~df.event_status.str.contains('full')
-        wait_not_null = ~df.wait_list.isnull()
-        cancel_not_null = ~df.cancel.isnull()
 
-        signup = df.loc[(df.event_cost == 0) & (attending_is_null)]
-        # signup = df.loc[(signup_not_null) & (attending_is_null) & (event_not_full)].drop_duplicates()
-        wait = df.loc[(wait_not_null) & (event_is_full) & (attending_is_null)].drop_duplicates()
-        cancel = df.loc[(cancel_not_null) & (attending_not_null)].drop_duplicates()
+    def _get_dataframes(self):
+        # One row per event, indexed by url; the partition files only contribute the marks typed into them
+        self.df = self.df.drop_duplicates('url').set_index('url', drop=False)
+        overlay = self._read_marks(glob(os.path.join(os.getcwd(), 'output', '*', '*.csv')))
+        if overlay is not None:
+            self.df.update(overlay)
+        df = self.df
+        if self._changed is not None:
+            df = df[df.url.isin(self._changed)]
+
+        events = EventIndex(df)
+        signup = events.frame(event_cost=0, attending__isnull=True)
+        # signup = events.frame(sign_up__isnull=False, attending__isnull=True, event_status='available')
+        wait = events.frame(wait_list__isnull=False, event_status='full', attending__isnull=True)
+        cancel = events.frame(cancel__isnull=False, attending__isnull=False)
 
         # signup = df.loc[
         #     (~df.sign_up.isnull()) &
@@ -491,16 +725,51 @@ class EAUpdater(object):
         return signup, wait, cancel
 
 
+    def _read_marks(self, files):
+        marks = ['sign_up', 'wait_list', 'cancel']
+        wanted = set(marks + ['url'])
+        edits = []
+        for filepath in files:
+            frame = pd.read_csv(filepath, usecols=lambda col: col in wanted)
+            if wanted.issubset(frame.columns):
+                edits.append(frame.dropna(how='all', subset=marks))
+        if not edits:
+            return None
+        # The first mark found for an event wins, column by column
+        return pd.concat(edits, ignore_index=True).groupby('url')[marks].first()
+
+
     def _override_dataframe(self):
         pass
 
 
+    def _queue_actions(self):
+        queue = []
+        for kind, frame in (('sign_up', self._signup), ('wait_list', self._wait), ('cancel', self._cancel)):
+            queue.extend(Action(kind, url, name) for url, name in zip(frame.url, frame.event_name))
+        return queue
+
+
     def take_action(self):
-        driver = login()
-        self._event_sign_up(driver)
-        # self._event_wait_list(driver)
-        # self._event_cancel(driver)
-        driver.close()
+        handlers = {'sign_up': self._event_sign_up, 'wait_list': self._event_wait_list, 'cancel': self._event_cancel}
+        handle = lambda driver, action: handlers[action.kind](driver, action)
+        sessions = session_manager()
+        pool = browsers.BrowserPool(lambda: login(sessions=sessions), self._workers)
+        try:
+            for action, result in zip(self._queue, pool.map(handle, self._queue)):
+                self._outcomes.append((action, result))
+                print('-> {:>9}: {} ({})'.format(action.kind.replace('_', ' ').title(), action.name, result))
+        finally:
+            pool.close()
+        self._apply_outcomes()
+
+
+    def _apply_outcomes(self):
+        # Every completed action of a kind is written back with one assignment through the url index
+        for kind, marks in self.__outcome_marks.items():
+            urls = [action.url for action, result in self._outcomes if action.kind == kind and result == 'done']
+            if urls:
+                self.df.loc[urls, list(marks)] = list(marks.values())
 
 
     def _click_signup(self, driver, url):
@@ -523,80 +792,65 @@ class EAUpdater(object):
                 waiver.click()
 
 
-    def _event_sign_up(self, driver):
-        for idx, row in self._signup.iterrows():
-            url = row.url
-            name = row.event_name
-            edate = self._parse_date(row.event_date)
+    def _check(self, checkbox):
+        if not checkbox.is_enabled():
+            return False
+        if not checkbox.is_selected():
+            checkbox.click()
+        return True
+
+
+    def _submit(self, driver, question):
+        submit = driver.find_element_by_id('contentMain_btnSubmit')
+        if not submit.is_enabled():
+            return 'unavailable'
+        with self._prompt_lock:
+            if raw_input(question) != 'y':
+                return 'declined'
+            submit.click()
+        return 'done'
 
-            self._click_signup(driver, url)
-            find = self._find_by_id(driver)
 
-            credit, credit_cb = self._parse_cost(find('contentMain_eventcredit').text), find('contentMain_chkPayEC')
-            price = self._calculate_payment_amount(
-                self._parse_cost(find('contentMain_eventcost').text),
-                self._parse_cost(find('contentMain_eventtax').text),
-                self._parse_cost(find('contentMain_venuecost').text),
-                credit
-            )
+    def _event_sign_up(self, driver, action):
+        self._click_signup(driver, action.url)
+        find = self._find_by_id(driver)
+
+        credit, credit_cb = self._parse_cost(find('contentMain_eventcredit').text), find('contentMain_chkPayEC')
+        price = self._calculate_payment_amount(
+            self._parse_cost(find('contentMain_eventcost').text),
+            self._parse_cost(find('contentMain_eventtax').text),
+            self._parse_cost(find('contentMain_venuecost').text),
+            credit
+        )
+        self._check(find('contentMain_chkSignup'))
+        self._acknowledge_waiver(driver)
+
+        # The credit and payment questions of one event are asked back to back
+        with self._prompt_lock:
             if credit and credit_cb.is_enabled():
                 if credit_cb.is_selected():
                     credit_cb.click()
-                ans = raw_input('Use ${:.2f} event credit? '.format(credit))
+                ans = raw_input('Use ${:.2f} event credit for {}? '.format(credit, action.name))
                 if ans == 'y':
                     credit_cb.click()
+            return self._submit(driver, 'Pay ${:,.2f} for {}? '.format(price, action.name))
 
-            signup = find('contentMain_chkSignup')
-            if signup.is_enabled():
-                if not signup.is_selected():
-                    signup.click()
 
-            self._acknowledge_waiver(driver)
+    def _event_wait_list(self, driver, action):
+        self._click_signup(driver, action.url)
+        if not self._check(self._find_by_id(driver)('contentMain_chkWaitList')):
+            return 'unavailable'
+        self._acknowledge_waiver(driver)
+        return self._submit(driver, 'Join the wait list for {}? '.format(action.name))
 
-            submit = find('contentMain_btnSubmit')
-            if submit.is_enabled():
-                ans = raw_input('Pay ${:,.2f} for {}? '.format(price, name))
-                if ans == 'y':
-                    submit.click()
-                    self.df.loc[
-                        (self.df.event_name == name) &
-                        (self.df.event_date == edate),
-                        ['attending', 'sign_up']
-                    ] = ['x', None]
-
-
-    # def _event_wait_list(self, driver):
-    #     for idx, row in self._wait.iterrows():
-    #         url = row.url
-    #         name = row.event_name
-    #         edate = self._parse_date(row.event_date)
-
-    #         self._click_signup(driver, url)
-    #         find = self._find_by_id(driver)
-
-    #         wait = find('contentMain_chkWaitList')
-    #         if wait.is_enabled():
-    #             if not wait.is_selected():
-    #                 wait.click()
-
-    #         self._acknowledge_waiver(driver)
 
-    #         submit = find('contentMain_btnSubmit')
-    #         if submit.is_enabled():
-    #             ans = raw_input('Cancel {}? '.format(name))
-    #             if ans == 'y':
-    #                 # submit.click()
-    #                 self.df.loc[
-    #                     (self.df.event_name == name) &
-    #                     (self.df.event_date == edate),
-    #                     ['attending', 'wait_list']
-    #                 ] = [None, None]
-
-
-    # def _event_cancel(self, driver):
-    #     for url in self._cancel.url:
-    #         self._click_signup(driver, url)
-    #         find = self._find_by_id(driver)
+    def _event_cancel(self, driver, action):
+        self._click_signup(driver, action.url)
+        # The cancel checkbox has no fixed id; ASP.NET ties it to its label
+        labels = driver.find_elements_by_xpath("//label[contains(., 'cancel my signup')]")
+        if not labels or not self._check(self._find_by_id(driver)(labels[0].get_attribute('for'))):
+            return 'unavailable'
+        return self._submit(driver, 'Cancel {}? '.format(action.name))
 
 
     def _parse_cost(self, cost):
@@ -609,14 +863,6 @@ class EAUpdater(object):
         except AttributeError:
             return Decimal('0.00')
 
-    def _parse_date(self, dstr):
-        _date, _time = dstr.split(' ')
-        month, day, year = _date.split('/')
-        year = '20' + year
-        hour, minute = _time.split(':')
-        res = pd.Timestamp(int(year), int(month), int(day), int(hour), int(minute))
-        return res.strftime('%Y-%m-%d %H:%M:%S')
-
 
     # sign up page element IDs
     # amount = 'contentMain_eventcost' -> Event Cost
@@ -634,10 +880,49 @@ class EAUpdater(object):
 
 
 def main():
+    parser = argparse.ArgumentParser(description='Load upcoming Events & Adventures events into output/')
+    parser.add_argument('--refresh', action='store_true', help='re-open every event instead of reusing the event store')
+    parser.add_argument('--partitions', action='store_true',
+                        help='also write one CSV per site, city, state, weekday, status and distance band (see query.py)')
+    archiving = parser.add_mutually_exclusive_group()
+    archiving.add_argument('--record', metavar='ZIP', default=None, help='save every site page and Maps answer into this archive')
+    archiving.add_argument('--replay', metavar='ZIP', default=None, help='load from a recorded archive without Chrome or the network')
+    parser.add_argument('--workers', type=int, default=4, help='headless browsers to spread the event pages across')
+    parser.add_argument('--months', type=int, default=3, help='calendar months to load, starting with the current one')
+    parser.add_argument('--until', type=lambda text: datetime.strptime(text, '%Y-%m-%d').date(), default=None,
+                        help='load every calendar month through this date (YYYY-MM-DD) instead of --months')
+    parser.add_argument('--radius', type=float, default=100,
+                        help='only look up driving times for venues within this many straight-line miles of HOME or WORK')
+    parser.add_argument('--any-distance', dest='radius', action='store_const', const=None,
+                        help='look up driving times for every venue')
+    parser.add_argument('--sort-chunk', type=int, default=None,
+                        help='sort the output CSV in runs of this many rows instead of in memory')
+    parser.add_argument('--metrics-textfile', default=None, help='also write the run metrics to this Prometheus textfile')
+    parser.add_argument('--profile', nargs='?', const='sample', choices=['sample', 'cprofile'], default=None,
+                        help='profile the run into output/profile (sampling, or cprofile for a deterministic profile too)')
+    args = parser.parse_args()
+
+    archive = Archive(args.record, 'record') if args.record else Archive(args.replay) if args.replay else None
+
     os.system('clear')
     # ea = EAUpdater()
-    ea = EALoader()
-    ea.write_files(all=True)
+    def run():
+        ea = EALoader(workers=args.workers, refresh=args.refresh, sort_chunk=args.sort_chunk, months=args.months, until=args.until,
+                      archive=archive, radius=args.radius)
+        ea.write_files(all=args.partitions)
+        return ea
+
+    try:
+        if args.profile:
+            directory = os.path.join(os.getcwd(), 'output', 'profile')
+            ea = profiling.profile(run, directory, args.profile)
+            profiling.write_event_times(ea._metrics.by_key('fetch_event'), os.path.join(directory, 'event_times.csv'))
+        else:
+            ea = run()
+    finally:
+        if archive:
+            archive.close()
+    ea.write_report(args.metrics_textfile)
 
 
 
@@ -0,0 +1,157 @@
+
+import os
+import json
+import time
+import threading
+from bisect import bisect_left
+from functools import wraps
+from contextlib import contextmanager
+from datetime import datetime
+
+
+# Upper edges (seconds) of the latency histogram buckets, as Prometheus uses them
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0]
+
+
+def timed(stage, key=None):
+    """Method decorator recording each call's wall time under `stage` in self._metrics.
+
+    With key, the time is also kept per value of that positional argument
+    (e.g. per event URL).
+    """
+    def decorate(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self._metrics.timer(stage, None if key is None else args[key]):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def _key(name, labels):
+    if not labels:
+        return name
+    return '{}{{{}}}'.format(name, ','.join('{}={}'.format(k, v) for k, v in sorted(labels.items())))
+
+
+class Histogram(object):
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.maximum = max(self.maximum, seconds)
+
+    @property
+    def calls(self):
+        return sum(self.counts)
+
+    def cumulative(self):
+        result, running = [], 0
+        for edge, count in zip(BUCKETS + ['+Inf'], self.counts):
+            running += count
+            result.append((edge, running))
+        return result
+
+
+class Metrics(object):
+    """Latency histograms per stage and labelled counters for one loader run.
+
+    Safe to share between the fetch threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = dict()
+        self._counters = dict()
+        self._labels = dict()
+        self._keyed = dict()
+        self._started = time.time()
+
+    @contextmanager
+    def timer(self, stage, key=None):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.time() - start, key)
+
+    def observe(self, stage, seconds, key=None):
+        with self._lock:
+            self._stages.setdefault(stage, Histogram()).observe(seconds)
+            if key is not None:
+                keyed = self._keyed.setdefault(stage, dict())
+                keyed[key] = keyed.get(key, 0.0) + seconds
+
+    def by_key(self, stage):
+        """{key: seconds} for a stage timed with a key, e.g. every event URL."""
+        with self._lock:
+            return dict(self._keyed.get(stage, {}))
+
+    def count(self, name, amount=1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+            self._labels[key] = (name, labels)
+
+    def report(self, **extra):
+        with self._lock:
+            stages = dict((stage, {
+                'calls': hist.calls, 'total_seconds': round(hist.total, 6),
+                'mean_seconds': round(hist.total / hist.calls, 6) if hist.calls else None,
+                'max_seconds': round(hist.maximum, 6),
+                'buckets': [[edge, count] for edge, count in hist.cumulative()],
+            }) for stage, hist in self._stages.items())
+            counters = dict(self._counters)
+            slowest = dict((stage, [[k, round(v, 6)] for k, v in sorted(keyed.items(), key=lambda item: -item[1])[:10]])
+                           for stage, keyed in self._keyed.items())
+        result = {
+            'started': datetime.fromtimestamp(self._started).isoformat(),
+            'wall_seconds': round(time.time() - self._started, 3),
+            'stages': stages, 'counters': counters, 'slowest': slowest,
+        }
+        result.update(extra)
+        return result
+
+    def write_json(self, path, **extra):
+        with open(path, 'w') as f:
+            json.dump(self.report(**extra), f, indent=2, sort_keys=True)
+
+    def write_report(self, directory, textfile=None, **extra):
+        """Timings and counters as directory/run_report.json, plus a Prometheus textfile if asked for."""
+        path = os.path.join(directory, 'run_report.json')
+        self.write_json(path, **extra)
+        if textfile:
+            self.write_prometheus(textfile)
+        print('\nRun report written to {}'.format(path))
+        return path
+
+    def write_prometheus(self, path, prefix='ea_loader'):
+        """Write the metrics in the node_exporter textfile format, replacing `path` atomically."""
+        lines = []
+        with self._lock:
+            if self._stages:
+                lines.append('# TYPE {}_stage_seconds histogram'.format(prefix))
+            for stage, hist in sorted(self._stages.items()):
+                for edge, count in hist.cumulative():
+                    lines.append('{}_stage_seconds_bucket{{stage="{}",le="{}"}} {}'.format(prefix, stage, edge, count))
+                lines.append('{}_stage_seconds_sum{{stage="{}"}} {}'.format(prefix, stage, hist.total))
+                lines.append('{}_stage_seconds_count{{stage="{}"}} {}'.format(prefix, stage, hist.calls))
+            typed = set()
+            for key, value in sorted(self._counters.items(), key=lambda item: (self._labels[item[0]][0], item[0])):
+                name, labels = self._labels[key]
+                metric = '{}_{}_total'.format(prefix, name.replace('.', '_'))
+                if metric not in typed:
+                    lines.append('# TYPE {} counter'.format(metric))
+                    typed.add(metric)
+                label = ','.join('{}="{}"'.format(k, v) for k, v in sorted(labels.items()))
+                lines.append('{}{} {}'.format(metric, '{{{}}}'.format(label) if label else '', value))
+
+        temp = '{}.tmp'.format(path)
+        with open(temp, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.rename(temp, path)
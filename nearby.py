@@ -0,0 +1,170 @@
+
+import numpy as np
+
+import ratelimit
+
+
+# Mean radius of the Earth in miles
+EARTH_RADIUS = 3958.8
+
+# Shown in place of (or in front of) the address of events at a member's home
+PRIVATE_ADDRESS = "We don't publish member addresses. Address emailed to those signed up"
+
+
+def geocode_text(address):
+    """The part of a venue's address text worth geocoding."""
+    return address.replace(PRIVATE_ADDRESS, '')
+
+
+def coordinates(result):
+    """(lat, lng) of the first answer of a geocode call, or (None, None) without one."""
+    try:
+        location = result[0]['geometry']['location']
+        return float(location['lat']), float(location['lng'])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None, None
+
+
+def haversine(lats, lngs, lat, lng):
+    """Great-circle miles from (lat, lng) to every point; NaN for points without coordinates."""
+    lats, lngs = np.radians(np.asarray(lats, dtype=float)), np.radians(np.asarray(lngs, dtype=float))
+    lat, lng = np.radians(lat), np.radians(lng)
+    a = np.sin((lats - lat) / 2) ** 2 + np.cos(lat) * np.cos(lats) * np.sin((lngs - lng) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+def within(lats, lngs, origins, radius):
+    """Mask of the points no more than `radius` miles in a straight line from any of `origins`.
+
+    Points without coordinates cannot be ruled out, so they count as within.
+    """
+    lats, lngs = np.asarray(lats, dtype=float), np.asarray(lngs, dtype=float)
+    near = np.isnan(lats) | np.isnan(lngs)
+    for lat, lng in origins:
+        with np.errstate(invalid='ignore'):
+            near |= haversine(lats, lngs, lat, lng) <= radius
+    return near
+
+
+class TravelData(object):
+    """Fills the driving distances and times from home and work into batches of loader rows.
+
+    - columns: the loader's output fields; address and code name its raw
+      venue text and zip code columns
+    - matrix(origins, destinations): {(origin, destination): (miles, minutes)}
+      from one distance_matrix call
+    - geocode(address): the geocode answer, used once for home and work
+    - unresolved(address): True for venue text the geocoder already found
+      nothing for; such venues are not sent to distance_matrix either
+
+    Destinations are looked up `chunk` at a time, one call covering both origins.
+    With a radius, venues farther than that many straight-line miles from both
+    home and work are left without travel data and never sent to distance_matrix.
+    """
+
+    def __init__(self, columns, matrix, geocode, home, work, radius=None, chunk=25, metrics=None,
+                 address='address', code='zip', unresolved=None):
+        self._field = columns.index
+        self._matrix = matrix
+        self._geocode = geocode
+        self._unresolved = unresolved or (lambda address: False)
+        self._names = [home, work]
+        self.radius = radius
+        self._chunk = chunk
+        self._metrics = metrics
+        self._address = address
+        self._code = code
+        # [(lat, lng)] of home and work, geocoded on first use
+        self.origins = None
+
+    def _count(self, name, amount=1, **labels):
+        if self._metrics:
+            self._metrics.count(name, amount, **labels)
+
+    def add(self, data):
+        rows = [list(items) for items in data]
+        return self.fill(rows, self.within_radius(rows, self.destinations(rows)))
+
+    def destinations(self, rows):
+        """The destination text of every row, None for rows that need no lookup."""
+        # Rows reused from the event store already carry their travel data
+        field = self._field
+        destinations = []
+        for row in rows:
+            if row[field('dist_from_home')] is not None:
+                destinations.append(None)
+            elif self.unresolvable(row):
+                self._count('unresolved_address')
+                destinations.append(None)
+            else:
+                destinations.append(self.destination(row))
+        return destinations
+
+    def unresolvable(self, row):
+        # Without coordinates the raw venue text is all there is, and the geocoder had no answer for it;
+        # each run would otherwise send it to distance_matrix again and get NOT_FOUND back
+        field = self._field
+        address = row[field(self._address)]
+        return bool(address) and row[field('latitude')] is None and self._unresolved(address)
+
+    def fill(self, rows, destinations):
+        """Tuples of rows with the travel data of their destinations filled in."""
+        field = self._field
+        home, work = self._names
+        unique = sorted(set(filter(None, destinations)))
+
+        travel = dict()
+        for start in range(0, len(unique), self._chunk):
+            try:
+                travel.update(self._matrix(self._names, unique[start:start + self._chunk]))
+            except ratelimit.GaveUp as error:
+                # These rows keep no travel data, so the next run looks them up again
+                print('-> Distance matrix failed: {}'.format(error))
+                self._count('maps_failed', destination='distance_matrix')
+
+        for row, destination in zip(rows, destinations):
+            if destination is None:
+                continue
+            row[field('dist_from_home')], row[field('time_from_home')] = travel.get((home, destination), (None, None))
+            row[field('dist_from_work')], row[field('time_from_work')] = travel.get((work, destination), (None, None))
+        return [tuple(row) for row in rows]
+
+    def within_radius(self, rows, destinations):
+        # Straight-line distances for the whole batch at once; far venues are not worth a distance_matrix element
+        if self.radius is None or not any(destinations):
+            return destinations
+        origins = self.origin_coordinates()
+        if not origins:
+            return destinations
+        field = self._field
+        near = within([row[field('latitude')] for row in rows], [row[field('longitude')] for row in rows],
+                      origins, self.radius)
+        far = sum(1 for destination, inside in zip(destinations, near) if destination and not inside)
+        if far:
+            self._count('beyond_radius', far)
+        return [destination if inside else None for destination, inside in zip(destinations, near)]
+
+    def origin_coordinates(self):
+        # Without both origins nothing can be ruled out, so every venue is looked up
+        if self.origins is None:
+            self.origins = []
+            for origin in self._names:
+                try:
+                    lat, lng = coordinates(self._geocode(origin))
+                except ratelimit.GaveUp as error:
+                    print('-> Geocoding {} failed: {}'.format(origin, error))
+                    self._count('maps_failed', destination='geocode')
+                    lat, lng = None, None
+                if lat is None:
+                    self.origins = []
+                    break
+                self.origins.append((lat, lng))
+        return self.origins
+
+    def destination(self, row):
+        # Unparsed venues keep their raw text; parsed ones are rebuilt from the geocoded parts
+        field = self._field
+        if row[field(self._address)]:
+            return row[field(self._address)]
+        street, city, state, code = [row[field(i)] for i in ('street', 'city', 'state', self._code)]
+        return ', '.join(filter(None, [street, city, ' '.join(filter(None, [state, code]))])) or None
@@ -0,0 +1,67 @@
+
+import os
+from shutil import rmtree
+
+import numpy as np
+import pandas as pd
+
+
+# Upper edges of the distance / time buckets written for the *_from_* columns
+RANGE_BINS = [10, 15, 20, 25, 30, 40, 50, 60, 100]
+
+
+def range_labels(col, bins=RANGE_BINS):
+    file_col = col.replace('_', ' ')
+    labels = ['{} less than {}'.format(file_col, bins[0])]
+    labels += ['{} between {} and {}'.format(file_col, n1, n2) for n1, n2 in zip(bins[:-1], bins[1:])]
+    labels.append('{} greater than {}'.format(file_col, bins[-1]))
+    return labels
+
+
+def range_buckets(values, col, bins=RANGE_BINS):
+    """Label every value with its bucket in one vectorized pass.
+
+    Buckets are open intervals, so a value sitting exactly on an edge
+    belongs to none of them (and missing values neither).
+    """
+    values = values.astype(float)
+    buckets = pd.cut(values, [-np.inf] + bins + [np.inf], right=False, labels=range_labels(col, bins))
+    return buckets.astype(object).where(~values.isin(bins))
+
+
+def clear_partitions(base, columns):
+    """Remove the partition directories of `columns` under base, with any marks typed into them."""
+    for col in columns:
+        directory = os.path.join(base, col)
+        if os.path.exists(directory):
+            rmtree(directory)
+
+
+def write_partitions(df, base, columns, numeric=None, output=None, filename=None):
+    """Write one CSV per value of each column, or per bucket for the *_from_* columns.
+
+    Every row is assigned to its partition with a single groupby per column
+    and each file is written exactly once, to base/<column>/<partition>.csv.
+
+    - numeric(col) names the column holding a *_from_* column's numbers
+    - output(frame) selects what goes into each file
+    - filename(value) turns a partition value into a file name
+    """
+    numeric = numeric or (lambda col: col)
+    output = output or (lambda frame: frame)
+    filename = filename or (lambda value: '{}'.format(value))
+
+    clear_partitions(base, columns)
+    for col in columns:
+        print('-> {}'.format(col))
+        directory = os.path.join(base, col)
+        os.mkdir(directory)
+
+        if '_from_' in col:
+            keys, name = range_buckets(df[numeric(col)], col), lambda label: label
+        else:
+            keys, name = df[col], filename
+
+        for value, frame in df.groupby(keys.values, sort=False):
+            filepath = os.path.join(directory, '{}.csv'.format(name(value)))
+            output(frame).to_csv(filepath, encoding='utf-8', index=False)
@@ -0,0 +1,131 @@
+
+import os
+import csv
+import heapq
+import tempfile
+from collections import deque
+from itertools import islice
+
+
+def ordered(pool, func, items, window):
+    """Lazy pool.imap that keeps at most `window` calls in flight.
+
+    Results come back in the order of `items`; the next item is only
+    handed to the pool once the oldest result has been taken.
+    """
+    pending = deque()
+    for item in items:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def batched(items, size):
+    items = iter(items)
+    while True:
+        batch = list(islice(items, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _cell(value):
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+class CsvSink(object):
+    """Appends rows to a CSV file as they arrive, behind a header of `columns`."""
+
+    def __init__(self, path, columns):
+        self.path = path
+        self.rows = 0
+        self._file = open(path, 'wb')
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(columns)
+
+    def write(self, rows):
+        for row in rows:
+            self._writer.writerow([_cell(value) for value in row])
+            self.rows += 1
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def _sort_key(positions, ascending):
+    # Numbers before text before empty cells, like DataFrame.sort_values
+    def key(row):
+        result = []
+        for pos, asc in zip(positions, ascending):
+            value = row[pos]
+            if value == '':
+                result.append((2, 0))
+                continue
+            try:
+                number = float(value)
+            except ValueError:
+                if not asc:
+                    raise ValueError('descending sort needs numbers, got {!r}'.format(value))
+                result.append((1, value))
+            else:
+                result.append((0, number if asc else -number))
+        return tuple(result)
+    return key
+
+
+def _write_rows(path, header, rows):
+    with open(path, 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+
+def _keyed_run(f, key, num):
+    # The run number keeps equal keys in file order, as a stable sort would
+    reader = csv.reader(f)
+    next(reader)
+    for line, row in enumerate(reader):
+        yield key(row), num, line, row
+
+
+def sort_csv(path, by, ascending=None, chunk_rows=None):
+    """Sort a CSV file in place by the columns `by`.
+
+    With chunk_rows the file is never held in memory at once: sorted runs
+    of chunk_rows rows go to temporary files and are merged back.
+    """
+    ascending = ascending or [True] * len(by)
+    with open(path, 'rb') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        key = _sort_key([header.index(col) for col in by], ascending)
+        if not chunk_rows:
+            rows = sorted(reader, key=key)
+        else:
+            runs = []
+            for chunk in batched(reader, chunk_rows):
+                handle = tempfile.NamedTemporaryFile(suffix='.csv', delete=False)
+                handle.close()
+                _write_rows(handle.name, header, sorted(chunk, key=key))
+                runs.append(handle.name)
+
+    if not chunk_rows:
+        _write_rows(path, header, rows)
+        return
+
+    files = [open(name, 'rb') for name in runs]
+    try:
+        streams = [_keyed_run(run_file, key, num) for num, run_file in enumerate(files)]
+        _write_rows(path, header, (row for _, _, _, row in heapq.merge(*streams)))
+    finally:
+        for run_file in files:
+            run_file.close()
+        for name in runs:
+            os.remove(name)
@@ -0,0 +1,70 @@
+
+import os
+import re
+import json
+from datetime import date
+
+
+# Used when there is no rules.json next to the output directory
+DEFAULT_RULES = {
+    'exclude_titles': [],
+    'exclude_patterns': [],
+    'exclude_weekdays': [],
+    'skip_past': True,
+}
+
+
+class Rules(object):
+    """Exclusions applied to calendar entries before their detail pages are fetched.
+
+    - exclude_titles: case-insensitive substrings of the calendar title
+    - exclude_patterns: regular expressions searched in the title
+    - exclude_weekdays: weekday names such as 'Monday'
+    - skip_past: drop entries dated before today
+    """
+
+    def __init__(self, exclude_titles=(), exclude_patterns=(), exclude_weekdays=(), skip_past=True):
+        self._titles = [title.lower() for title in exclude_titles]
+        self._patterns = [re.compile(pattern, re.I) for pattern in exclude_patterns]
+        self._weekdays = set(day.lower() for day in exclude_weekdays)
+        self._skip_past = skip_past
+
+    @classmethod
+    def load(cls, path, exclude_titles=()):
+        """The rules in the JSON file at path, or DEFAULT_RULES without one.
+
+        exclude_titles are the titles the loader's own page parser drops anyway;
+        they always apply, and the file's exclude_titles are added to them.
+        """
+        rules = dict(DEFAULT_RULES)
+        if path and os.path.exists(path):
+            with open(path) as f:
+                rules.update(json.load(f))
+        rules['exclude_titles'] = list(exclude_titles) + list(rules['exclude_titles'])
+        return cls(**rules)
+
+    def reason(self, entry, today=None):
+        """Why entry can be skipped without opening it, or None to keep it."""
+        title = entry.title.lower()
+        if any(excluded in title for excluded in self._titles):
+            return 'calendar_title'
+        if any(pattern.search(entry.title) for pattern in self._patterns):
+            return 'calendar_pattern'
+        if entry.day is not None:
+            if self._skip_past and entry.day < (today or date.today()):
+                return 'calendar_past'
+            if entry.day.strftime('%A').lower() in self._weekdays:
+                return 'calendar_weekday'
+        return None
+
+    def links(self, entries, metrics=None):
+        """URLs of the entries that pass, counting the others by reason."""
+        today = date.today()
+        links = []
+        for entry in entries:
+            reason = self.reason(entry, today)
+            if reason is None:
+                links.append(entry.url)
+            elif metrics:
+                metrics.count('skipped', reason=reason)
+        return links
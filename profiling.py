@@ -0,0 +1,115 @@
+
+import os
+import sys
+import csv
+import time
+import pstats
+import cProfile
+import threading
+from collections import Counter
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return '{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+class Sampler(object):
+    """Wall-clock sampling profiler covering every thread.
+
+    A background thread records the stack of each other thread every
+    `interval` seconds, so fetch threads waiting on the network show up
+    as well as parsing. Stacks are kept in the folded format flamegraph.pl
+    and speedscope read.
+    """
+
+    def __init__(self, interval=0.005):
+        self._interval = interval
+        self._stacks = Counter()
+        self._samples = 0
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._sample)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._thread.join()
+
+    def _sample(self):
+        own = threading.current_thread().ident
+        while self._running:
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame))
+                    frame = frame.f_back
+                self._stacks[';'.join(reversed(stack))] += 1
+            self._samples += 1
+            time.sleep(self._interval)
+
+    def write_folded(self, path):
+        with open(path, 'w') as f:
+            for stack, count in self._stacks.most_common():
+                f.write('{} {}\n'.format(stack, count))
+
+    def write_hotspots(self, path, limit=50):
+        # Self counts the samples a function was running in, total those it was anywhere on the stack
+        own, total = Counter(), Counter()
+        for stack, count in self._stacks.items():
+            frames = stack.split(';')
+            own[frames[-1]] += count
+            for name in set(frames):
+                total[name] += count
+        stacks = sum(self._stacks.values()) or 1
+        with open(path, 'w') as f:
+            f.write('{} samples every {:.0f} ms across all threads (idle waits included)\n\n'.format(
+                self._samples, self._interval * 1000))
+            f.write('{:>8} {:>8}  {}\n'.format('self %', 'total %', 'function'))
+            for name, count in own.most_common(limit):
+                f.write('{:>8.2f} {:>8.2f}  {}\n'.format(100.0 * count / stacks, 100.0 * total[name] / stacks, name))
+
+
+def profile(func, directory, mode='sample'):
+    """Run func() under the sampler, plus cProfile when mode is 'cprofile', and write the reports to directory.
+
+    - hotspots.txt: functions sorted by sampled self time
+    - stacks.folded: stacks for flamegraph.pl / speedscope
+    - cprofile.txt and run.prof: deterministic profile of the calling thread
+    """
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    sampler = Sampler()
+    profiler = cProfile.Profile() if mode == 'cprofile' else None
+
+    sampler.start()
+    if profiler:
+        profiler.enable()
+    try:
+        return func()
+    finally:
+        if profiler:
+            profiler.disable()
+        sampler.stop()
+        sampler.write_hotspots(os.path.join(directory, 'hotspots.txt'))
+        sampler.write_folded(os.path.join(directory, 'stacks.folded'))
+        if profiler:
+            profiler.dump_stats(os.path.join(directory, 'run.prof'))
+            with open(os.path.join(directory, 'cprofile.txt'), 'w') as f:
+                pstats.Stats(profiler, stream=f).sort_stats('cumulative').print_stats(60)
+        print('\nProfile written to {}'.format(directory))
+
+
+def write_event_times(times, path):
+    """Write {url: seconds} as a CSV, slowest event first."""
+    with open(path, 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerow(['url', 'seconds'])
+        for url, seconds in sorted(times.items(), key=lambda item: -item[1]):
+            writer.writerow([url, '{:.4f}'.format(seconds)])
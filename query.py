@@ -0,0 +1,209 @@
+"""
+Indexed, in-memory filters over the loaded events.
+
+    python query.py event_day=Saturday dist_from_home__lt=25 event_cost__lt=20 spots_left__gt=0
+
+Each filter is column=value or column__op=value with op one of lt, le,
+gt, ge, in (comma separated values) or isnull (true/false).
+"""
+import os
+import argparse
+
+import numpy as np
+import pandas as pd
+
+import columnar
+
+
+# Columns searched by value ranges; the date columns come from columnar.DATE_COLUMNS
+RANGE_COLUMNS = ['dist_from_home', 'time_from_home', 'dist_from_work', 'time_from_work', 'event_cost', 'event_tax',
+                 'venue_cost', 'spots_left', 'attendees', 'limit', 'duration', 'latitude', 'longitude']
+
+
+_COMPARE = {'lt': np.less, 'le': np.less_equal, 'gt': np.greater, 'ge': np.greater_equal, 'eq': np.equal}
+
+
+class _Sorted(object):
+    """A column's values by row, and its non-missing values in order with the row position of each."""
+
+    def __init__(self, values):
+        self.by_row = values
+        positions = np.flatnonzero(~pd.isnull(values))
+        order = np.argsort(values[positions], kind='mergesort')
+        self.values = values[positions][order]
+        self.positions = positions[order]
+
+    def span(self, op, bound):
+        """(start, stop) in self.values of the rows for which `value op bound` holds."""
+        start, stop = 0, len(self.values)
+        if op in ('gt', 'ge', 'eq'):
+            start = np.searchsorted(self.values, bound, 'right' if op == 'gt' else 'left')
+        if op in ('lt', 'le', 'eq'):
+            stop = np.searchsorted(self.values, bound, 'left' if op == 'lt' else 'right')
+        return start, max(start, stop)
+
+
+class _Hashed(object):
+    """Code of every row's value, and the row positions holding each value."""
+
+    def __init__(self, values):
+        self.codes, uniques = pd.factorize(values)
+        self.code = dict((value, code) for code, value in enumerate(uniques))
+        self.positions = pd.Series(np.arange(len(values))).groupby(self.codes).indices
+
+
+class _Filter(object):
+    """One condition: its matching positions (`size` of them) and a test for candidate rows."""
+
+    def __init__(self, size, positions, test):
+        self.size = size
+        self.positions = positions
+        self.test = test
+
+
+class EventIndex(object):
+    """Indexes over an events frame that answer compound filters without scanning it.
+
+    - date columns: sorted, searched by bisection
+    - categorical columns (site, city, state, weekday, statuses): value -> row positions
+    - distances, times, money and counts: sorted, searched by bisection
+
+    Filters are keyword arguments, e.g. positions(event_day='Saturday',
+    dist_from_home__lt=25, event_cost__lt=20, spots_left__gt=0). The most
+    selective condition picks the candidate rows from its index and the
+    others only check those candidates. Money held in cents
+    (columnar.numeric) is compared in dollars. Each index is built on first
+    use and kept, so the frame must not change afterwards.
+    """
+
+    def __init__(self, df):
+        self.df = df
+        self._columns = set(df.columns)
+        self._all = np.arange(len(df))
+        self._hashed = dict()
+        self._sorted = dict()
+        self._nulls = dict()
+        self._cents = set(col for col in columnar.MONEY_COLUMNS if col in df and str(df[col].dtype) == 'Int64')
+
+    def _hash_index(self, col):
+        if col not in self._hashed:
+            self._hashed[col] = _Hashed(self.df[col].astype(object).values)
+        return self._hashed[col]
+
+    def _sorted_index(self, col):
+        if col not in self._sorted:
+            if col in columnar.DATE_COLUMNS:
+                values = pd.to_datetime(self.df[col]).values
+            else:
+                values = pd.to_numeric(self.df[col], errors='coerce').astype(float).values
+            self._sorted[col] = _Sorted(values)
+        return self._sorted[col]
+
+    def _null_mask(self, col):
+        if col not in self._nulls:
+            self._nulls[col] = np.asarray(pd.isnull(self.df[col]))
+        return self._nulls[col]
+
+    def _bound(self, col, value):
+        if col in columnar.DATE_COLUMNS:
+            return pd.Timestamp(value).to_datetime64()
+        value = float(value)
+        return value * 100 if col in self._cents else value
+
+    def _filter(self, col, op, value):
+        if col not in self._columns:
+            raise ValueError('no column {!r} to filter on'.format(col))
+        if op not in ('eq', 'in', 'isnull') + tuple(_COMPARE):
+            raise ValueError('unknown filter {}__{}'.format(col, op))
+
+        if op == 'isnull':
+            nulls = self._null_mask(col)
+            wanted = bool(value)
+            return _Filter(len(nulls), lambda: np.flatnonzero(nulls == wanted), lambda rows: nulls[rows] == wanted)
+
+        values = list(value) if op == 'in' else [value]
+        if col in RANGE_COLUMNS or col in columnar.DATE_COLUMNS:
+            index = self._sorted_index(col)
+            if op == 'in':
+                bounds = [self._bound(col, v) for v in values]
+                spans = [index.span('eq', bound) for bound in bounds]
+                return _Filter(sum(stop - start for start, stop in spans),
+                               lambda: np.concatenate([index.positions[start:stop] for start, stop in spans]),
+                               lambda rows: np.in1d(index.by_row[rows], bounds))
+            bound = self._bound(col, value)
+            start, stop = index.span(op, bound)
+            compare = _COMPARE[op]
+            return _Filter(stop - start, lambda: index.positions[start:stop],
+                           lambda rows: compare(index.by_row[rows], bound))
+
+        if op != 'eq' and op != 'in':
+            raise ValueError('{!r} has no range index'.format(col))
+        index = self._hash_index(col)
+        codes = [index.code[v] for v in values if v in index.code]
+        found = [index.positions[code] for code in codes]
+        if len(codes) == 1:
+            code = codes[0]
+            return _Filter(len(found[0]), lambda: found[0], lambda rows: index.codes[rows] == code)
+        return _Filter(sum(len(positions) for positions in found),
+                       lambda: np.concatenate(found) if found else self._all[:0],
+                       lambda rows: np.in1d(index.codes[rows], codes))
+
+    def positions(self, **filters):
+        """Sorted row positions matching every filter."""
+        if not filters:
+            return self._all
+        conditions = sorted((self._filter(col, op or 'eq', value)
+                             for col, _, op, value in ((key.partition('__') + (value,)) for key, value in filters.items())),
+                            key=lambda condition: condition.size)
+        rows = np.sort(conditions[0].positions())
+        for condition in conditions[1:]:
+            if not len(rows):
+                break
+            rows = rows[condition.test(rows)]
+        return rows
+
+    def count(self, **filters):
+        return len(self.positions(**filters))
+
+    def frame(self, **filters):
+        """The rows of the frame matching every filter, in frame order."""
+        return self.df.iloc[self.positions(**filters)]
+
+
+def load(path=None):
+    """EventIndex over the loader output, preferring the Parquet copy."""
+    path = path or os.path.join(os.getcwd(), 'output', 'events_and_adventures.csv')
+    pqpath = os.path.splitext(path)[0] + '.parquet'
+    if columnar.available() and os.path.exists(pqpath) and os.path.getmtime(pqpath) >= os.path.getmtime(path):
+        return EventIndex(columnar.read(pqpath))
+    return EventIndex(columnar.compact(pd.read_csv(path)))
+
+
+def _parse_filter(text):
+    key, _, value = text.partition('=')
+    op = key.partition('__')[2]
+    if op == 'isnull':
+        return key, value.lower() in ('1', 'true', 'yes', 'y')
+    if op == 'in':
+        return key, value.split(',')
+    return key, value
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter, epilog=__doc__)
+    parser.add_argument('filters', nargs='*', help='column=value or column__op=value')
+    parser.add_argument('--csv', default=None, help='events CSV (defaults to output/events_and_adventures.csv)')
+    parser.add_argument('--columns', default='event_date,event_day,event_name,sitename,event_cost,spots_left,dist_from_home',
+                        help='comma separated columns to print')
+    args = parser.parse_args()
+
+    index = load(args.csv)
+    frame = columnar.readable(index.frame(**dict(_parse_filter(text) for text in args.filters)))
+    columns = [col for col in args.columns.split(',') if col in frame]
+    print(frame[columns].to_string(index=False) if len(frame) else 'No matching events')
+    print('\n{} of {} events'.format(len(frame), len(index.df)))
+
+
+if __name__ == '__main__':
+    main()
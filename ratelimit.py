@@ -0,0 +1,160 @@
+
+import time
+import random
+import threading
+
+import requests
+import googlemaps
+
+
+# Requests per second allowed to each destination (None means unlimited)
+RATES = {'site': 20, 'geocode': 40, 'distance_matrix': 10}
+UNLIMITED = dict.fromkeys(RATES)
+
+# Maps statuses that mean "slow down" rather than "this request is wrong"
+QUOTA_STATUSES = ('OVER_QUERY_LIMIT', 'RESOURCE_EXHAUSTED')
+
+
+class Throttled(Exception):
+    """The destination asked us to slow down (HTTP 429/503, Maps OVER_QUERY_LIMIT)."""
+
+
+class GaveUp(Exception):
+    """A call still failed after every retry."""
+
+    def __init__(self, destination, error):
+        super(GaveUp, self).__init__('{}: {}'.format(destination, error))
+        self.destination = destination
+        self.error = error
+
+
+class TokenBucket(object):
+    """Allows `rate` acquisitions per second on average and bursts of up to `burst`."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or max(1, rate))
+        self._tokens = self.capacity
+        self._stamp = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(self.capacity, self._tokens + (now - self._stamp) * self.rate)
+                self._stamp = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class AIMDLimit(object):
+    """Concurrency limit that grows by one per limit's worth of successes and halves when throttled."""
+
+    def __init__(self, initial, maximum, minimum=1):
+        self.minimum = minimum
+        self.maximum = max(maximum, minimum)
+        self.limit = float(min(max(initial, minimum), self.maximum))
+        self._active = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self._active >= int(self.limit):
+                self._cond.wait()
+            self._active += 1
+
+    def release(self, throttled=False):
+        with self._cond:
+            self._active -= 1
+            if throttled:
+                self.limit = max(self.minimum, self.limit / 2)
+            else:
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            self._cond.notify_all()
+
+
+class Destination(object):
+    """Token bucket, adaptive concurrency and bounded retries with jitter for one kind of traffic."""
+
+    def __init__(self, name, rate, concurrency, max_concurrency, retries=4, backoff=0.5,
+                 retry_on=(Throttled,)):
+        self.name = name
+        self._bucket = TokenBucket(rate) if rate else None
+        self.limit = AIMDLimit(concurrency, max_concurrency)
+        self._retries = retries
+        self._backoff = backoff
+        self._retry_on = retry_on
+        # Set by the loader so retries show up in its run report
+        self.metrics = None
+
+    def call(self, func, *args, **kwargs):
+        for attempt in range(self._retries + 1):
+            if self._bucket:
+                self._bucket.acquire()
+            self.limit.acquire()
+            throttled = False
+            try:
+                return func(*args, **kwargs)
+            except self._retry_on as error:
+                throttled = True
+                if attempt == self._retries:
+                    raise GaveUp(self.name, error)
+            finally:
+                self.limit.release(throttled)
+            if self.metrics:
+                self.metrics.count('retries', destination=self.name)
+            # Full jitter keeps retrying workers from hitting the destination in lockstep
+            time.sleep(random.uniform(0, self._backoff * 2 ** attempt))
+
+
+def default_limits(workers=1, rates=RATES, retries=4):
+    """{destination: Destination} for the site (at most `workers` pages at once), geocode and distance_matrix."""
+    network = (Throttled, requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+    maps = (Throttled, googlemaps.exceptions.Timeout, googlemaps.exceptions.TransportError)
+    return {
+        'site': Destination('site', rates['site'], min(4, workers), workers, retries, retry_on=network),
+        'geocode': Destination('geocode', rates['geocode'], 4, 16, retries, retry_on=maps),
+        'distance_matrix': Destination('distance_matrix', rates['distance_matrix'], 2, 8, retries, retry_on=maps),
+    }
+
+
+def replay_limits(workers=1):
+    """Limits for pages and Maps answers served from a local archive: no rate, and no retries for what is missing."""
+    return default_limits(workers, UNLIMITED, retries=0)
+
+
+def fetch(session, url):
+    """session.get(url), raising Throttled when the site answers 429 or 503."""
+    response = session.get(url)
+    if response.status_code in (429, 503):
+        raise Throttled('{} {}'.format(response.status_code, url))
+    return response
+
+
+class LimitedMaps(object):
+    """googlemaps.Client whose geocode and distance_matrix calls go through their Destination."""
+
+    def __init__(self, client, limits):
+        self.client = client
+        self._limits = limits
+
+    def _checked(self, method, *args, **kwargs):
+        try:
+            result = method(*args, **kwargs)
+        except googlemaps.exceptions.ApiError as error:
+            if error.status in QUOTA_STATUSES:
+                raise Throttled(error.status)
+            raise
+        if isinstance(result, dict) and result.get('status') in QUOTA_STATUSES:
+            raise Throttled(result['status'])
+        return result
+
+    def geocode(self, *args, **kwargs):
+        return self._limits['geocode'].call(self._checked, self.client.geocode, *args, **kwargs)
+
+    def distance_matrix(self, *args, **kwargs):
+        return self._limits['distance_matrix'].call(self._checked, self.client.distance_matrix, *args, **kwargs)
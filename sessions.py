@@ -0,0 +1,159 @@
+
+import os
+import json
+import time
+import threading
+from urlparse import urlparse
+
+import requests
+
+import discovery
+import ratelimit
+
+
+# Element of the logon form; a page showing it means the session is gone
+USERNAME_ID = 'contentMain_username'
+
+
+class SessionManager(object):
+    """One login shared by every requests session and WebDriver of a run, and by later runs.
+
+    The site's cookies (the ASP.NET auth ticket among them) are kept in
+    `path` until they expire, or for `ttl` seconds when the site does not
+    say. Logging in again only happens when a response lands on the logon
+    page, and only once however many threads notice it at the same time.
+    """
+
+    def __init__(self, login_url, username, password, path=None, ttl=20 * 60):
+        self.login_url = login_url
+        self._username = username
+        self._password = password
+        self._path = path
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._cookies = []
+        self._expires = 0
+        self._calendar_url = None
+        self._landing_url = None
+        # Bumped on every login so threads that saw the same lapse do not all log in
+        self._generation = 0
+        self.logins = 0
+        self._load()
+
+    def _load(self):
+        if not self._path or not os.path.exists(self._path):
+            return
+        try:
+            with open(self._path) as f:
+                saved = json.load(f)
+        except ValueError:
+            return
+        if saved.get('expires', 0) > time.time():
+            self._cookies = saved['cookies']
+            self._expires = saved['expires']
+            self._calendar_url = saved.get('calendar_url')
+            self._landing_url = saved.get('landing_url')
+
+    def _save(self):
+        if not self._path:
+            return
+        directory = os.path.dirname(self._path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        temp = '{}.tmp'.format(self._path)
+        # The cookies are as good as the password while they last
+        with os.fdopen(os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+            json.dump({'cookies': self._cookies, 'expires': self._expires, 'calendar_url': self._calendar_url,
+                       'landing_url': self._landing_url}, f)
+        os.rename(temp, self._path)
+
+    def _keep(self, cookies, landing_url, calendar_url=None):
+        expiries = [cookie['expires'] for cookie in cookies if cookie.get('expires')]
+        self._cookies = cookies
+        self._expires = min(expiries + [time.time() + self._ttl])
+        self._landing_url = landing_url
+        self._calendar_url = calendar_url or self._calendar_url
+        self._generation += 1
+        self.logins += 1
+        self._save()
+
+    @property
+    def live(self):
+        return bool(self._cookies) and self._expires > time.time()
+
+    def lapsed(self, url, content):
+        """True when a page is the logon form, i.e. the site no longer knows the session."""
+        if urlparse(url).path.lower() == urlparse(self.login_url).path.lower():
+            return True
+        return USERNAME_ID in content if isinstance(content, basestring) else False
+
+    ##########################
+    #### requests support ####
+    ##########################
+
+    def session(self, session=None):
+        """session (or a new requests.Session) carrying the stored cookies."""
+        session = session or requests.Session()
+        for cookie in self._cookies:
+            session.cookies.set(cookie['name'], cookie['value'], domain=cookie.get('domain'),
+                                path=cookie.get('path') or '/', secure=cookie.get('secure', False),
+                                expires=cookie.get('expires'))
+        return session
+
+    def login(self, session):
+        """Post the logon form with session and return the calendar page."""
+        landing = discovery.sign_in(session, self.login_url, self._username, self._password)
+        calendar = discovery.open_calendar(session, landing)
+        cookies = [{'name': c.name, 'value': c.value, 'domain': c.domain, 'path': c.path, 'secure': c.secure,
+                    'expires': c.expires} for c in session.cookies]
+        self._keep(cookies, landing.url, calendar.url)
+        return calendar
+
+    def calendar(self, session):
+        """The calendar page for session, logging in only when the stored login is missing or lapsed."""
+        with self._lock:
+            if self.live and self._calendar_url:
+                self.session(session)
+                response = session.get(self._calendar_url)
+                if not self.lapsed(response.url, response.content):
+                    return response
+            return self.login(session)
+
+    def get(self, session, url):
+        """ratelimit.fetch(session, url), logging back in once if the session has lapsed."""
+        generation = self._generation
+        response = ratelimit.fetch(session, url)
+        if not self.lapsed(response.url, response.content):
+            return response
+        with self._lock:
+            if generation == self._generation:
+                self.login(session)
+            else:
+                self.session(session)
+        return ratelimit.fetch(session, url)
+
+    ###########################
+    #### WebDriver support ####
+    ###########################
+
+    def restore(self, driver):
+        """Give driver the stored login; False when there is none or the site refuses it."""
+        if not self.live or not self._landing_url:
+            return False
+        # Cookies can only be set for the domain the browser is on
+        driver.get(self.login_url)
+        for cookie in self._cookies:
+            item = {'name': cookie['name'], 'value': cookie['value'], 'path': cookie.get('path') or '/',
+                    'secure': bool(cookie.get('secure'))}
+            if cookie.get('expires'):
+                item['expiry'] = int(cookie['expires'])
+            driver.add_cookie(item)
+        driver.get(self._landing_url)
+        return not self.lapsed(driver.current_url, driver.page_source)
+
+    def capture(self, driver):
+        """Keep the cookies of a driver that has just logged in through the form."""
+        cookies = [{'name': c['name'], 'value': c['value'], 'domain': c.get('domain'), 'path': c.get('path'),
+                    'secure': c.get('secure', False), 'expires': c.get('expiry')} for c in driver.get_cookies()]
+        with self._lock:
+            self._keep(cookies, driver.current_url)
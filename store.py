@@ -0,0 +1,119 @@
+
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import threading
+import cPickle as pickle
+from collections import namedtuple
+from datetime import datetime
+
+
+StoredEvent = namedtuple('StoredEvent', ['row', 'content_hash', 'fetched'])
+
+# ASP.NET state changes on every request without the event changing
+_HIDDEN_INPUT = re.compile(r'<input[^>]*type="hidden"[^>]*>', re.IGNORECASE)
+
+# Skip reasons a member can undo, so their markers must not outlive a stored row
+VOLATILE_SKIPS = ('cancelled',)
+
+
+def stale_reason(row, columns, now=None):
+    """Why a stored row cannot be used this run ('skipped_before' or 'passed'), or None when it can.
+
+    Stored rows still have to pass the date filters applied when they were parsed.
+    """
+    if row is None:
+        return 'skipped_before'
+    now = now or datetime.now()
+    field = columns.index
+    if row[field('event_date')] < now or row[field('signup_before')] < now:
+        return 'passed'
+    return None
+
+
+def content_hash(content):
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+    return hashlib.sha1(_HIDDEN_INPUT.sub('', content)).hexdigest()
+
+
+class EventStore(object):
+    """Parsed event rows kept between runs in SQLite, keyed by event URL.
+
+    A row of None records an event the loader skipped, so it is not fetched
+    again. Entries are pruned once their `expires` time has passed.
+    """
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS events ('
+            'url TEXT PRIMARY KEY, row BLOB, content_hash TEXT, fetched REAL NOT NULL, expires REAL)'
+        )
+        self._conn.commit()
+
+
+    def get(self, url, width=None):
+        """The StoredEvent for url, or None.
+
+        With width, a row of another length (stored before the columns last
+        changed) counts as not stored, so its page is parsed again.
+        """
+        with self._lock:
+            res = self._conn.execute('SELECT row, content_hash, fetched FROM events WHERE url = ?', (url,)).fetchone()
+        if res is None:
+            return None
+        row, digest, fetched = res
+        row = pickle.loads(str(row)) if row is not None else None
+        if width is not None and row is not None and len(row) != width:
+            return None
+        return StoredEvent(row, digest, fetched)
+
+
+    def put(self, url, row, digest, expires=None):
+        blob = sqlite3.Binary(pickle.dumps(row, pickle.HIGHEST_PROTOCOL)) if row is not None else None
+        expires = time.mktime(expires.timetuple()) if isinstance(expires, datetime) else expires
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO events VALUES (?, ?, ?, ?, ?)',
+                               (url, blob, digest, time.time(), expires))
+            self._conn.commit()
+
+
+    def update(self, url, row):
+        """Replace the stored row without marking the page as freshly fetched."""
+        blob = sqlite3.Binary(pickle.dumps(row, pickle.HIGHEST_PROTOCOL))
+        with self._lock:
+            self._conn.execute('UPDATE events SET row = ? WHERE url = ?', (blob, url))
+            self._conn.commit()
+
+
+    def update_rows(self, rows, key):
+        """update() every row, keyed by row[key], in one transaction."""
+        blobs = [(sqlite3.Binary(pickle.dumps(row, pickle.HIGHEST_PROTOCOL)), row[key]) for row in rows]
+        with self._lock:
+            self._conn.executemany('UPDATE events SET row = ? WHERE url = ?', blobs)
+            self._conn.commit()
+
+
+    def touch(self, url):
+        with self._lock:
+            self._conn.execute('UPDATE events SET fetched = ? WHERE url = ?', (time.time(), url))
+            self._conn.commit()
+
+
+    def prune(self):
+        with self._lock:
+            count = self._conn.execute('DELETE FROM events WHERE expires < ?', (time.time(),)).rowcount
+            self._conn.commit()
+        return count
+
+
+    def close(self):
+        with self._lock:
+            self._conn.close()